@@ -0,0 +1,412 @@
+from pathlib import Path
+from types import SimpleNamespace
+from time import sleep, perf_counter
+import argparse
+import asyncio
+import builtins
+import tempfile
+import threading
+import random
+import shutil
+import json
+import sys
+import os
+
+import bo3_workshop_download as bwd
+from pyrogram.enums import ChatType
+from pyrogram.raw.functions.messages import SendMedia, SendMultiMedia, UploadMedia
+from pyrogram.raw.functions.upload import SaveBigFilePart
+from pyrogram.raw.types import UpdateNewChannelMessage
+
+
+BENCHMARK_CHANNEL = -1001000000001
+BENCHMARK_FIRST_ID = 3000000001
+BENCHMARK_STAGES = ('download', 'archive', 'image_fetch', 'post', 'upload')
+BENCHMARK_HIGHLIGHTS = 4
+BENCHMARK_IMAGE_SIZE = 200 * 1024
+
+# prints the lines steamcmd.exe prints and writes a synthetic item for every +workshop_download_item
+FAKE_STEAMCMD = r'''
+import sys, os, json, time
+
+item_bytes = int(os.environ['BENCHMARK_ITEM_BYTES'])
+download_speed = float(os.environ['BENCHMARK_DOWNLOAD_SPEED'])
+
+print("Redirecting stderr to 'logs\\stderr.txt'")
+print('[  0%] Checking for available updates...')
+print('[----] Verifying installation...')
+print('Steam Console Client (c) Valve Corporation - version 1700000000')
+print('-- type \'quit\' to exit --')
+print('Loading Steam API...OK')
+print('')
+print('Connecting anonymously to Steam Public...OK')
+print('Waiting for client config...OK')
+print('Waiting for user info...OK', flush=True)
+
+for arg in sys.argv[1:]:
+    if not arg.startswith('+workshop_download_item'):
+        continue
+
+    workshop_id = arg.split()[2]
+    print(f'Downloading item {workshop_id} ...', flush=True)
+
+    item_path = os.path.join('steamapps', 'workshop', 'content', '311210', workshop_id)
+    os.makedirs(item_path, exist_ok=True)
+    folder_name = f'zm_bench_{workshop_id}'
+    with open(os.path.join(item_path, 'workshop.json'), 'w') as fhandle:
+        fhandle.write(json.dumps({
+            'PublisherID': workshop_id,
+            'Title': f'Benchmark Map {workshop_id}',
+            'FolderName': folder_name,
+            'Description': 'Synthetic item written by the benchmark',
+            'Type': 'map',
+            'Tags': 'Zombies,Map',
+        }))
+
+    # fastfiles are already compressed, only the small text file shrinks
+    item_files = [
+        (f'{folder_name}.ff', item_bytes * 6 // 10, True),
+        (f'en_{folder_name}.ff', item_bytes // 10, True),
+        (f'{folder_name}.xpak', item_bytes * 3 // 10 - 64 * 1024, True),
+        (f'{folder_name}.txt', 64 * 1024, False),
+    ]
+    for file_name, file_bytes, random_bytes in item_files:
+        with open(os.path.join(item_path, file_name), 'wb') as fhandle:
+            written = 0
+            while written < file_bytes:
+                chunk_size = min(1024 * 1024, file_bytes - written)
+                fhandle.write(os.urandom(chunk_size) if random_bytes else b'benchmark ' * (chunk_size // 10) + b' ' * (chunk_size % 10))
+                written += chunk_size
+                if download_speed:
+                    time.sleep(chunk_size / download_speed)
+
+    print(f'Success. Downloaded item {workshop_id} to "{os.path.abspath(item_path)}" ({item_bytes} bytes) ', flush=True)
+'''
+
+
+class FakeArchiver(bwd.Archiver):
+    name = 'fake'
+    extension = '.bin'
+    default_level = 0
+
+    def __init__(self, volume_size, threads=1, level=None):
+        super().__init__(threads, level)
+        self.volume_size = volume_size
+
+    def write_archive(self, files_json, norm_workshopname):
+        # stores the files one after the other, the cost of reading and writing without any compression
+        source_path = bwd.GAME_CONTENT_PATH.joinpath(norm_workshopname)
+        volume_writer = bwd.VolumeWriter(self.archive_path(files_json, norm_workshopname), self.volume_size)
+        for relative_path in files_json['manifest']:
+            with open(source_path.joinpath(files_json['FolderName'], 'zone', relative_path), 'rb') as fhandle:
+                for chunk in iter(lambda: fhandle.read(1024 * 1024), b''):
+                    volume_writer.write(chunk)
+        volume_writer.close()
+
+        shutil.rmtree(source_path)
+
+
+class FakeMessage:
+    def __init__(self, client, chat_id, msg_id):
+        self.client = client
+        self.chat = SimpleNamespace(id=chat_id)
+        self.id = msg_id
+        self.link = f'https://t.me/c/{str(chat_id)[4:]}/{msg_id}'
+
+    async def edit_caption(self, caption, parse_mode=None):
+        await self.client.request()
+
+    async def reply_media_group(self, media):
+        await self.client.request(sum(media_item.media.getbuffer().nbytes for media_item in media))
+        return [FakeMessage(self.client, self.chat.id, self.client.next_id()) for _ in media]
+
+    async def reply_photo(self, photo):
+        await self.client.request()
+        return FakeMessage(self.client, self.chat.id, self.client.next_id())
+
+
+class FakeClient:
+    def __init__(self, latency, upload_speed):
+        self.latency = latency
+        self.upload_speed = upload_speed
+        self.message_id = 0
+        self.uploaded_bytes = 0
+        self.lock = threading.Lock()
+        self.connection_lock = asyncio.Lock()
+        self.loop = None
+
+    def check_loop(self):
+        # a pyrogram client only works on the loop it was started on, the fake fails the same calls
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            self.loop = self.loop or loop
+        if not loop is self.loop:
+            raise Exception('FakeClient called outside of the event loop it was started on')
+
+    async def request(self, payload_bytes=0):
+        self.check_loop()
+        with self.lock:
+            self.uploaded_bytes += payload_bytes
+
+        await asyncio.sleep(self.latency)
+        if self.upload_speed and payload_bytes:
+            # one connection sends one payload at a time, like a throttled session
+            async with self.connection_lock:
+                await asyncio.sleep(payload_bytes / self.upload_speed)
+
+    def next_id(self):
+        with self.lock:
+            self.message_id += 1
+            return self.message_id
+
+    async def get_me(self):
+        self.check_loop()
+        return SimpleNamespace(id=1)
+
+    def rnd_id(self):
+        return random.getrandbits(63)
+
+    async def get_chat(self, chat_id):
+        await self.request()
+        return SimpleNamespace(
+            id=chat_id,
+            type=ChatType.CHANNEL,
+            title=f'Benchmark {chat_id}',
+            linked_chat=SimpleNamespace(id=chat_id - 1, title=f'Benchmark {chat_id} comments')
+        )
+
+    async def resolve_peer(self, peer_id):
+        self.check_loop()
+        return peer_id
+
+    async def send_photo(self, chat_id, photo, caption=None, parse_mode=None):
+        await self.request()
+        return FakeMessage(self, chat_id, self.next_id())
+
+    async def send_message(self, chat_id, text, parse_mode=None, disable_web_page_preview=None):
+        await self.request()
+        return FakeMessage(self, chat_id, self.next_id())
+
+    async def get_messages(self, chat_id, message_ids):
+        await self.request()
+        return FakeMessage(self, chat_id, message_ids)
+
+    async def get_discussion_message(self, chat_id, message_id):
+        await self.request()
+        return FakeMessage(self, chat_id - 1, self.next_id())
+
+    async def save_file(self, path, progress=None, progress_args=()):
+        file_size = Path(path).stat().st_size
+        await self.request(file_size)
+        if progress:
+            progress(file_size, file_size, *progress_args)
+
+        return SimpleNamespace(name=Path(path).name)
+
+    async def invoke(self, query, sleep_threshold=None):
+        if isinstance(query, SaveBigFilePart):
+            await self.request(len(query.bytes))
+            return True
+
+        if isinstance(query, UploadMedia):
+            await self.request()
+            return SimpleNamespace(document=SimpleNamespace(id=self.rnd_id(), access_hash=self.rnd_id(), file_reference=os.urandom(16)))
+
+        if isinstance(query, (SendMedia, SendMultiMedia)):
+            await self.request()
+            sent_msg = SimpleNamespace(id=self.next_id())
+            return SimpleNamespace(updates=[UpdateNewChannelMessage(message=sent_msg, pts=0, pts_count=0)])
+
+        raise Exception(f'FakeClient does not implement {type(query).__name__}')
+
+    async def stop(self):
+        self.check_loop()
+
+
+class FakeHttpSession:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get(self, url, timeout=None):
+        sleep(self.latency)
+        return SimpleNamespace(content=os.urandom(BENCHMARK_IMAGE_SIZE), raise_for_status=lambda: None)
+
+
+def fake_steam_data(workshop_id):
+    # what the Steam web API gives make_telegram_post, without the network
+    return {
+        'Title': f'Benchmark Map {workshop_id}',
+        'authors': 'benchmark',
+        'date_string': '2024.01.01',
+        'time_updated': 1700000000,
+        'images': {
+            'preview': f'https://images.example/{workshop_id}/preview.jpg',
+            'highlights': [f'https://images.example/{workshop_id}/{i}.jpg' for i in range(BENCHMARK_HIGHLIGHTS)],
+        },
+    }
+
+
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ('cb', wintypes.DWORD),
+                ('PageFaultCount', wintypes.DWORD),
+                ('PeakWorkingSetSize', ctypes.c_size_t),
+                ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t),
+                ('PeakPagefileUsage', ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize
+
+    # kilobytes on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def setup_workdir(workdir, args):
+    bwd.INITIAL_CWD = workdir
+    bwd.CACHE_DIR = workdir.joinpath('telegramcache')
+    bwd.CACHE_INDEX_PATH = bwd.CACHE_DIR.joinpath('index.json')
+    bwd.HTTP_CACHE_DIR = bwd.CACHE_DIR.joinpath('httpcache')
+    bwd.UPLOAD_CHECKPOINT_DIR = bwd.CACHE_DIR.joinpath('uploads')
+    bwd.GAME_CONTENT_PATH = workdir.joinpath('steamapps', 'workshop', 'content', '311210')
+    bwd.GAME_DOWNLOADS_PATH = workdir.joinpath('steamapps', 'workshop', 'downloads', '311210')
+    bwd.CACHE_DIR.mkdir(parents=True)
+    bwd.GAME_CONTENT_PATH.mkdir(parents=True)
+
+    bwd.JOB_STORE = bwd.JobStore(bwd.CACHE_DIR.joinpath('jobs.db'))
+    bwd.IMAGE_CACHE = bwd.ImageCache(bwd.CACHE_DIR.joinpath('imagecache'), bwd.IMAGE_MEMORY_CACHE_SIZE, bwd.IMAGE_DISK_CACHE_SIZE)
+    bwd.HTTP_SESSION = FakeHttpSession(args.latency / 1000)
+    bwd.PROGRESS.interval = args.progress_interval
+
+    fake_steamcmd_path = workdir.joinpath('fake_steamcmd.py')
+    fake_steamcmd_path.write_text(FAKE_STEAMCMD)
+    os.environ['BENCHMARK_ITEM_BYTES'] = str(args.item_size * 1024 * 1024)
+    os.environ['BENCHMARK_DOWNLOAD_SPEED'] = str(args.download_speed * 1024 * 1024)
+
+    real_popen = bwd.popen
+    def fake_popen(cmd, cwd=None):
+        if cmd[0] == 'steamcmd.exe':
+            cmd = [sys.executable, str(fake_steamcmd_path)] + cmd[1:]
+        return real_popen(cmd, cwd)
+
+    # the main session and every extra upload session have their own connection
+    tg_clients = {
+        session_name: FakeClient(args.latency / 1000, args.upload_speed * 1024 * 1024)
+        for session_name in [bwd.SESSION_NAME] + [f'upload{i + 1}' for i in range(args.upload_sessions)]
+    }
+    bwd.UPLOAD_POOL = bwd.SessionPool([session_name for session_name in tg_clients if not session_name == bwd.SESSION_NAME])
+    bwd.popen = fake_popen
+    bwd.fetch_steam_page = lambda workshop_id: SimpleNamespace()
+    bwd.fetch_steam_data = lambda workshop_id, steam_soup=None, metadata_provider=None: fake_steam_data(workshop_id)
+    bwd.ensure_telegram_connection = lambda session_name=bwd.SESSION_NAME: tg_clients[session_name]
+
+    return tg_clients
+
+
+def run_flow(name, action, answers):
+    # the interactive prompts of the flow are answered from the list
+    pending_answers = list(answers)
+    real_input = builtins.input
+    builtins.input = lambda prompt='': pending_answers.pop(0)
+    bwd.METRICS = bwd.Metrics(bwd.CACHE_DIR.joinpath(f'metrics-{name}.jsonl'), bwd.CACHE_DIR.joinpath(f'metrics-{name}.prom'))
+
+    start = perf_counter()
+    try:
+        action()
+    finally:
+        builtins.input = real_input
+    wall_time = perf_counter() - start
+
+    bwd.METRICS.write_prometheus()
+    stages = {
+        stage: {**counters, 'throughput': counters['bytes'] / counters['seconds'] if counters['seconds'] else 0.0}
+        for stage, counters in bwd.METRICS.stages.items()
+    }
+    return {'flow': name, 'seconds': wall_time, 'peak_rss': peak_rss(), 'stages': stages}
+
+
+def print_report(results):
+    print()
+    for result in results:
+        print(f'{result["flow"]}: {result["seconds"]:0.2f}s, peak RSS {bwd.format_bytes(result["peak_rss"])}')
+        for stage in BENCHMARK_STAGES:
+            counters = result['stages'].get(stage)
+            if not counters:
+                continue
+
+            print(
+                f'  {stage:<12} {counters["runs"]:>4} run(s) {counters["seconds"]:>8.2f}s '
+                f'{bwd.format_bytes(counters["bytes"]):>9} {bwd.format_bytes(counters["throughput"]):>9}/s '
+                f'{counters["failures"]} failed, {counters["retries"]} retried'
+            )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of bo3_workshop_download.py with fake steamcmd, archiver and Telegram client.')
+    parser.add_argument('--items', type=int, default=3, help='synthetic workshop items to generate')
+    parser.add_argument('--item-size', type=int, default=64, help='size of every item in MB')
+    parser.add_argument('--volume-size', type=int, default=24, help='archive volume size in MB')
+    parser.add_argument('--download-speed', type=float, default=0, help='fake steamcmd download speed in MB/s (0 is unlimited)')
+    parser.add_argument('--upload-speed', type=float, default=0, help='fake telegram upload speed in MB/s (0 is unlimited)')
+    parser.add_argument('--latency', type=float, default=20, help='fake telegram and image request latency in ms')
+    parser.add_argument('--upload-sessions', type=int, default=0, help='extra fake upload sessions, each with its own --upload-speed')
+    parser.add_argument('--volume-workers', type=int, default=bwd.UPLOAD_VOLUME_WORKERS)
+    parser.add_argument('--part-workers', type=int, default=bwd.UPLOAD_PART_WORKERS)
+    parser.add_argument('--progress-interval', type=float, default=bwd.PROGRESS_INTERVAL, help='seconds between progress lines')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as json')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary work folder')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    workdir = Path(tempfile.mkdtemp(prefix='bo3_benchmark_'))
+    tg_clients = setup_workdir(workdir, args)
+    archiver = FakeArchiver(args.volume_size * 1024 * 1024)
+
+    workshop_ids = [str(BENCHMARK_FIRST_ID + i) for i in range(args.items)]
+    # posted without files, so it leaves the downloaded items pending for the cache upload
+    post_only_id = str(BENCHMARK_FIRST_ID + args.items)
+    channel = str(BENCHMARK_CHANNEL)
+    results = []
+    try:
+        def steam_flow():
+            for _ in workshop_ids:
+                bwd.steam_action(archiver)
+
+        results.append(run_flow('steam_action', steam_flow, workshop_ids))
+        results.append(run_flow('telegram_action', lambda: bwd.telegram_action(args), [channel, post_only_id]))
+        results.append(run_flow('cache_upload', lambda: bwd.check_and_upload_cache_action(args), ['y', ','.join(str(i + 1) for i in range(len(workshop_ids))), channel]))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f'Work folder kept at {workdir}')
+
+    print_report(results)
+    print()
+    for session_name, tg_client in tg_clients.items():
+        print(f'Fake telegram received {bwd.format_bytes(tg_client.uploaded_bytes)} through {session_name}')
+
+    if args.json:
+        with open(args.json, 'w') as fhandle:
+            fhandle.write(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
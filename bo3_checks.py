@@ -0,0 +1,207 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from contextlib import contextmanager
+from pathlib import Path
+import argparse
+import tempfile
+import threading
+import shutil
+import json
+import sys
+
+import bo3_workshop_download as bwd
+
+
+FIXTURES_DIR = Path(__file__).parent.joinpath('fixtures')
+# trimmed item and changelog pages, with some of the markup around the nodes that are read
+STEAM_ITEM_FIXTURE = FIXTURES_DIR.joinpath('steam_item.html')
+STEAM_CHANGELOG_FIXTURE = FIXTURES_DIR.joinpath('steam_changelog.html')
+STUB_CREATOR_ID = '76561198000000001'
+# what GetPublishedFileDetails answers, trimmed to the fields that are read
+STUB_FILE_DETAILS = {
+    '3000000001': {
+        'publishedfileid': '3000000001', 'result': 1, 'consumer_app_id': 311210, 'creator': STUB_CREATOR_ID,
+        'title': ' Stub Map One ', 'file_size': '123456789', 'time_updated': 1700000000,
+        'preview_url': 'https://images.example/3000000001/preview.jpg?imw=5000',
+    },
+    '3000000002': {
+        'publishedfileid': '3000000002', 'result': 1, 'consumer_app_id': 311210, 'creator': STUB_CREATOR_ID,
+        'title': 'Stub Map Two', 'file_size': '0', 'time_updated': 1700086400,
+        'preview_url': 'https://images.example/3000000002/preview.jpg',
+    },
+    # an item of another game and a deleted one are left out of the results
+    '3000000003': {
+        'publishedfileid': '3000000003', 'result': 1, 'consumer_app_id': 440, 'creator': STUB_CREATOR_ID,
+        'title': 'Other Game Item', 'file_size': '1', 'time_updated': 1700000000,
+        'preview_url': 'https://images.example/3000000003/preview.jpg',
+    },
+    '3000000004': {'publishedfileid': '3000000004', 'result': 9},
+}
+STUB_PREVIEWS = {
+    '3000000001': [
+        {'preview_type': 0, 'sortorder': 2, 'url': 'https://images.example/3000000001/2.jpg?imw=5000'},
+        {'preview_type': 1, 'sortorder': 1, 'youtubevideoid': 'stub'},
+        {'preview_type': 0, 'sortorder': 1, 'url': 'https://images.example/3000000001/1.jpg'},
+    ],
+}
+STUB_COLLECTIONS = {
+    '3000000100': [
+        {'publishedfileid': '3000000002', 'sortorder': 2, 'filetype': 0},
+        {'publishedfileid': '3000000001', 'sortorder': 1, 'filetype': 0},
+    ],
+}
+
+
+class SteamApiStub(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.answer(url.path, parse_qs(url.query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        self.answer(urlsplit(self.path).path, parse_qs(body))
+
+    def answer(self, path, params):
+        self.server.requests.append(path)
+        ids = [values[0] for name, values in params.items() if name.startswith('publishedfileids[')]
+
+        if path == '/ISteamRemoteStorage/GetPublishedFileDetails/v1/':
+            response = {'result': 1, 'publishedfiledetails': [STUB_FILE_DETAILS.get(workshop_id, {'publishedfileid': workshop_id, 'result': 9}) for workshop_id in ids]}
+        elif path == '/ISteamRemoteStorage/GetCollectionDetails/v1/':
+            response = {'result': 1, 'collectiondetails': [
+                {'publishedfileid': workshop_id, 'result': 1, 'children': STUB_COLLECTIONS[workshop_id]} if workshop_id in STUB_COLLECTIONS else {'publishedfileid': workshop_id, 'result': 9}
+                for workshop_id in ids
+            ]}
+        elif path == '/IPublishedFileService/GetDetails/v1/':
+            response = {'publishedfiledetails': [{'publishedfileid': workshop_id, 'previews': STUB_PREVIEWS.get(workshop_id, [])} for workshop_id in ids]}
+        elif path == '/ISteamUser/GetPlayerSummaries/v2/':
+            response = {'players': [{'steamid': steam_id, 'personaname': 'Stub Creator'} for steam_id in params['steamids'][0].split(',')]}
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps({'response': response}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def steam_api_stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SteamApiStub)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    http_cache_dir = Path(tempfile.mkdtemp(prefix='bo3_checks_'))
+    previous = (bwd.STEAM_API_URL, bwd.STEAM_API_KEY, bwd.HTTP_CACHE_DIR)
+    bwd.STEAM_API_URL = f'http://127.0.0.1:{server.server_port}/'
+    bwd.STEAM_API_KEY = 'stub'
+    bwd.HTTP_CACHE_DIR = http_cache_dir
+    try:
+        yield server.requests
+    finally:
+        (bwd.STEAM_API_URL, bwd.STEAM_API_KEY, bwd.HTTP_CACHE_DIR) = previous
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(http_cache_dir, ignore_errors=True)
+
+
+def expect(name, value, expected):
+    if not value == expected:
+        raise Exception(f'{name} is {value!r}, expected {expected!r}')
+
+
+def check_steam_api():
+    with steam_api_stub() as requests:
+        steam_data_batch = bwd.fetch_steam_data_batch(list(STUB_FILE_DETAILS))
+        expect('items', sorted(steam_data_batch), ['3000000001', '3000000002'])
+        expect('requests', requests.count('/ISteamRemoteStorage/GetPublishedFileDetails/v1/'), 1)
+
+        steam_data = steam_data_batch['3000000001']
+        expect('title', steam_data['Title'], 'Stub Map One')
+        expect('authors', steam_data['authors'], 'Stub Creator')
+        expect('time_updated', steam_data['time_updated'], 1700000000)
+        expect('file_size', steam_data['file_size'], 123456789)
+        expect('preview', steam_data['images']['preview'], 'https://images.example/3000000001/preview.jpg' + bwd.STEAM_PREVIEW_PARAMS)
+        expect('highlights', steam_data['images']['highlights'], [
+            'https://images.example/3000000001/1.jpg' + bwd.STEAM_HIGHLIGHT_PARAMS,
+            'https://images.example/3000000001/2.jpg' + bwd.STEAM_HIGHLIGHT_PARAMS,
+        ])
+        expect('unknown file_size', steam_data_batch['3000000002']['file_size'], None)
+
+        # co-authors are only listed on the item page
+        steam_soup = bwd.parse_steam_html(STEAM_ITEM_FIXTURE.read_bytes())
+        steam_data = bwd.complete_steam_data('3000000001', {**steam_data, 'images': {**steam_data['images'], 'highlights': None}}, steam_soup)
+        expect('page authors', steam_data['authors'], 'Stub Creator, Stub Helper')
+        expect('page highlights', len(steam_data['images']['highlights']), 2)
+
+        collection_children = bwd.fetch_collection_children(['3000000100', '3000000001'])
+        expect('collections', collection_children, {'3000000100': ['3000000001', '3000000002']})
+
+
+def check_html_extractors():
+    item_html = STEAM_ITEM_FIXTURE.read_bytes()
+    changelog_html = STEAM_CHANGELOG_FIXTURE.read_bytes()
+    expected = {
+        'date_string': '2024.03.12',
+        'time_updated': 1710255840,
+        'authors': 'Stub Creator, Stub Helper',
+        'images': {
+            'highlights': [
+                'https://images.steamusercontent.com/ugc/1/AAAA/' + bwd.STEAM_HIGHLIGHT_PARAMS,
+                'https://images.steamusercontent.com/ugc/2/BBBB/' + bwd.STEAM_HIGHLIGHT_PARAMS,
+            ],
+            'preview': 'https://images.steamusercontent.com/ugc/0/PREVIEW/' + bwd.STEAM_PREVIEW_PARAMS,
+        },
+        'Title': 'Stub Map One',
+    }
+
+    for html_extractor in bwd.HTML_EXTRACTORS:
+        try:
+            steam_soup = bwd.parse_steam_html(item_html, html_extractor)
+            changelog_soup = bwd.parse_steam_html(changelog_html, html_extractor)
+        except bwd.FeatureNotFound:
+            print(f'[Check] html_extractors: {html_extractor} skipped, parser not installed')
+            continue
+
+        expect(f'{html_extractor} steam data', bwd.scrape_steam_data(steam_soup, changelog_soup), expected)
+
+
+CHECKS = {
+    'steam_api': check_steam_api,
+    'html_extractors': check_html_extractors,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Checks of bo3_workshop_download.py against local stubs and saved pages, without Steam or Telegram.')
+    parser.add_argument('checks', nargs='*', metavar='CHECK', help=f'checks to run (default all): {", ".join(CHECKS)}')
+    args = parser.parse_args()
+    for check_name in args.checks:
+        if not check_name in CHECKS:
+            parser.error(f'unknown check {check_name}')
+
+    return args
+
+
+def main():
+    args = parse_args()
+    failed = 0
+    for check_name in args.checks or CHECKS:
+        try:
+            CHECKS[check_name]()
+            print(f'[Check] {check_name} ok')
+        except Exception as e:
+            print(f'[Check] {check_name} failed: {e}')
+            failed += 1
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
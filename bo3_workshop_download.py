@@ -1,27 +1,50 @@
 from pathlib import Path
 from enum import Enum
 import subprocess
+import threading
+import argparse
+import queue
 import os
 import json
 import shutil
-from time import sleep
+from time import sleep, perf_counter, time
 from datetime import datetime
 from math import ceil
 from io import BytesIO, StringIO
 from mimetypes import MimeTypes
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from collections import OrderedDict, deque
 import re
+import zlib
+import struct
+import zipfile
+import tarfile
+import hashlib
+import tracemalloc
+import sqlite3
+import asyncio
+from http import HTTPStatus
+from contextlib import contextmanager
 
 from pyrogram import Client
 from pyrogram.types import InputMediaPhoto
-from pyrogram.errors import PeerIdInvalid
+from pyrogram.errors import PeerIdInvalid, FilePartMissing, FilePartsInvalid, FileReferenceExpired, FileReferenceInvalid, MediaEmpty, FloodWait
 from pyrogram.enums import ChatType, ParseMode
-from pyrogram.raw.functions.messages import SendMultiMedia, UploadMedia
-from pyrogram.raw.types import InputSingleMedia, InputDocument, InputMediaDocument, InputMediaUploadedDocument, DocumentAttributeFilename, UpdateNewMessage, UpdateNewChannelMessage, UpdateNewScheduledMessage
+from pyrogram.raw.functions.messages import SendMedia, SendMultiMedia, UploadMedia
+from pyrogram.raw.functions.upload import SaveBigFilePart
+from pyrogram.raw.types import InputFileBig, InputSingleMedia, InputDocument, InputMediaDocument, InputMediaUploadedDocument, DocumentAttributeFilename, UpdateNewMessage, UpdateNewChannelMessage, UpdateNewScheduledMessage
 from pyrogram.raw.types.messages import Messages
 from pyrogram.mime_types import mime_types
 from pyrogram.utils import parse_messages
 import requests
-from bs4 import BeautifulSoup, Tag
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer, Tag, FeatureNotFound
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 mimetypes = MimeTypes()
@@ -32,7 +55,9 @@ STEAM_URL = 'https://steamcommunity.com/sharedfiles/filedetails/'
 INITIAL_CWD = Path.cwd()
 CACHE_DIR = INITIAL_CWD.joinpath('telegramcache')
 GAME_CONTENT_PATH = INITIAL_CWD.joinpath('steamapps', 'workshop', 'content', '311210')
+GAME_DOWNLOADS_PATH = INITIAL_CWD.joinpath('steamapps', 'workshop', 'downloads', '311210')
 RAR_PATH = Path('C:\\', 'Program Files', 'WinRAR')
+SEVENZIP_PATH = Path('C:\\', 'Program Files', '7-Zip')
 
 RAR_COMMENT_CONTENTS = """====== COD Resources ======
 
@@ -49,34 +74,255 @@ RAR_COMMENT_CONTENTS = """====== COD Resources ======
 RAR_COMMENT_FILENAME = 'README.txt'
 ALL_LANGS = ('bp', 'ea', 'en', 'es', 'fr', 'ge', 'it', 'ru')
 SESSION_NAME = 'user'
-UNLINK_EXCLUDE = (Path(__file__).name, 'steamcmd.exe', 'telegramcache', '.venv', f'{SESSION_NAME}.session')
+STEAMCMD_WORKERS_DIR = INITIAL_CWD.joinpath('steamcmd_workers')
+UNLINK_EXCLUDE = (Path(__file__).name, 'steamcmd.exe', 'telegramcache', '.venv', f'{SESSION_NAME}.session', STEAMCMD_WORKERS_DIR.name)
+SESSION_SUFFIXES = ('.session', '.session-journal')
+STEAMCMD_LOCK = threading.Lock()
+CACHE_INDEX_PATH = CACHE_DIR.joinpath('index.json')
+JOB_STATES = ('queued', 'downloaded', 'packaged', 'posted', 'files_uploaded', 'done')
+JOB_PENDING_STATES = ('packaged', 'posted', 'files_uploaded')
+JOB_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    workshop_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    time_updated INTEGER,
+    data TEXT NOT NULL DEFAULT '{}',
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, updated_at);
+CREATE TABLE IF NOT EXISTS posts (
+    workshop_id TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    state TEXT NOT NULL,
+    post_chat_id INTEGER,
+    post_msg_id INTEGER,
+    comment_msg_id INTEGER,
+    files_msg_id INTEGER,
+    images_sent INTEGER NOT NULL DEFAULT 0,
+    sent_files TEXT NOT NULL DEFAULT '[]',
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (workshop_id, channel)
+);
+"""
+HTTP_CACHE_DIR = CACHE_DIR.joinpath('httpcache')
+HTTP_CACHE_TTL = 10 * 60
+HTTP_IMAGE_CACHE_TTL = 30 * 24 * 60 * 60
+HTTP_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+HTTP_RETRIES = 3
+HTTP_TIMEOUT = 30
+STEAM_API_URL = os.environ.get('STEAM_API_URL', 'https://api.steampowered.com/')
+STEAM_API_KEY = os.environ.get('STEAM_API_KEY')
+STEAM_API_BATCH_SIZE = 100
+STEAM_PROFILE_NAME_REGEX = re.compile(r'<steamID><!\[CDATA\[(.*?)\]\]></steamID>', re.DOTALL)
+STEAM_PREVIEW_PARAMS = '?imw=637&imh=358'
+STEAM_HIGHLIGHT_PARAMS = '?imw=637&imh=358&impolicy=Letterbox&ima=fit'
+METADATA_PROVIDER = 'api'
+MANIFEST_HASHES = False
+TELEGRAM_MESSAGE_LIMIT = 4096
+IMAGE_FETCH_WORKERS = 6
+IMAGE_FETCH_RATE = 8
+IMAGE_MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+IMAGE_DISK_CACHE_SIZE = 512 * 1024 * 1024
+HTML_EXTRACTORS = ('full', 'strainer', 'lxml')
+HTML_EXTRACTOR = 'strainer'
+STEAM_PAGE_CLASSES = ('error_ctn', 'creatorsBlock', 'workshopItemTitle', 'changeLogCtn')
+STEAM_PAGE_SELECTORS = (
+    'div.error_ctn',
+    'div.creatorsBlock',
+    'img#previewImageMain',
+    'img#previewImage',
+    'div#highlight_player_area',
+    'div.workshopItemTitle',
+    'div.detailBox > div.changelog',
+    'div.changeLogCtn > p[id]',
+)
+UPLOAD_PART_SIZE = 512 * 1024
+UPLOAD_BIG_FILE_SIZE = 10 * 1024 * 1024
+UPLOAD_VOLUME_WORKERS = 3
+UPLOAD_PART_WORKERS = 4
+PROGRESS_INTERVAL = 2
+METRICS_WRITE_INTERVAL = 5
+METRICS_PROMETHEUS_COUNTERS = (
+    ('bo3_workshop_stage_runs_total', 'Runs of each pipeline stage', 'runs'),
+    ('bo3_workshop_stage_failures_total', 'Failed runs of each pipeline stage', 'failures'),
+    ('bo3_workshop_stage_seconds_total', 'Seconds spent in each pipeline stage', 'seconds'),
+    ('bo3_workshop_stage_bytes_total', 'Bytes moved by each pipeline stage', 'bytes'),
+    ('bo3_workshop_stage_retries_total', 'Retries inside each pipeline stage', 'retries'),
+)
+UPLOAD_PART_RETRIES = 3
+UPLOAD_RETRY_DELAY = 5
+UPLOAD_CHECKPOINT_DIR = CACHE_DIR.joinpath('uploads')
+UPLOAD_CHECKPOINT_INTERVAL = 2
+UPLOAD_CHECKPOINT_TTL = 6 * 60 * 60
 
 
 class Outputs(Enum):
+    DOWNLOAD_START = 'Downloading item'
     DOWNLOAD_SUCCESS = 'Success. Downloaded item'
     DOWNLOAD_TIMEOUT = 'ERROR! Timeout downloading'
     DOWNLOAD_FAILURE = 'failed (Failure).'
 
 
-def popen(cmd):
+STEAMCMD_ITEM_REGEX = re.compile(r'item (\d+)')
+STEAMCMD_BYTES_REGEX = re.compile(r'\((\d+) bytes\)')
+STEAMCMD_POLL_INTERVAL = 1
+STEAMCMD_SAMPLE_INTERVAL = 5
+STEAMCMD_STALL_TIMEOUT = 90
+STEAMCMD_RESET_TIMEOUTS = 3
+STEAMCMD_MAX_FAILURES = 5
+RAR_VOLUME_REGEX = re.compile(r'\.part(\d+)\.rar$')
+RAR_VOLUME_POLL_INTERVAL = 1
+ARCHIVE_VOLUME_SIZE = 2000 * 1024 * 1024
+ARCHIVE_THREADS = os.cpu_count() or 1
+# already compressed zone data, stored instead of compressed again
+ARCHIVE_TYPE_LEVELS = {'.ff': 0, '.xpak': 0, '.ipak': 0}
+ARCHIVE_STORE_RATIO = 1.05
+ARCHIVE_SAMPLE_SIZE = 256 * 1024
+ARCHIVE_SAMPLE_COUNT = 3
+ZIP_BLOCK_SIZE = 1024 * 1024
+ZIP_DICTIONARY_SIZE = 32 * 1024
+STAGING_FREE_SPACE_MARGIN = 64 * 1024 * 1024
+# the download or the staged content and the archive written from it are on disk at the same time
+DISK_FOOTPRINT_FACTOR = 2
+WATCH_MIN_INTERVAL = 10 * 60
+WATCH_MAX_INTERVAL = 6 * 60 * 60
+WATCH_BACKOFF = 2
+SERVE_HOST = '127.0.0.1'
+SERVICE_MODES = ('cache', 'upload')
+SERVICE_RESULT_FIELDS = ('Title', 'content_size', 'archive_bytes', 'rar_files', 'telegram_link', 'telegram_links')
+
+
+def popen(cmd, cwd=None):
     return subprocess.Popen(
         cmd,
+        cwd=cwd,
         stdout=subprocess.PIPE, 
         stdin=subprocess.PIPE, 
         stderr=subprocess.STDOUT, 
         universal_newlines=True, 
-        shell=True,
+        shell=os.name == 'nt',
+    )
+
+
+def remove_steamcmd_object(folder_object, content_path, pending_ids=()):
+    # the content folder survives a reset with everything in it but the pending items,
+    # the pipeline stages and packages earlier items there while steamcmd downloads the next ones
+    if folder_object == content_path:
+        for workshop_id in pending_ids:
+            item_path = content_path.joinpath(workshop_id)
+            if item_path.is_dir():
+                shutil.rmtree(item_path)
+    elif folder_object.is_dir() and not folder_object.is_symlink() and folder_object in content_path.parents:
+        for child_object in folder_object.iterdir():
+            remove_steamcmd_object(child_object, content_path, pending_ids)
+    elif folder_object.is_file() or folder_object.is_symlink():
+        folder_object.unlink()
+    elif folder_object.is_dir():
+        shutil.rmtree(folder_object)
+
+
+def reset_steamcmd(pending_ids=()):
+    if INITIAL_CWD.joinpath('steamcmd.exe').exists():
+        for folder_object in INITIAL_CWD.iterdir():
+            if not folder_object.name in UNLINK_EXCLUDE and not folder_object.suffix in SESSION_SUFFIXES:
+                remove_steamcmd_object(folder_object, GAME_CONTENT_PATH, pending_ids)
+
+
+def make_http_session():
+    session = requests.Session()
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=('GET', 'POST'),
+        respect_retry_after_header=True
     )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+HTTP_SESSION = make_http_session()
+
+
+def http_cache_paths(url, params=None):
+    cache_key = hashlib.sha1(f'{url}?{sorted((params or {}).items())}'.encode()).hexdigest()
+    return (HTTP_CACHE_DIR.joinpath(f'{cache_key}.json'), HTTP_CACHE_DIR.joinpath(f'{cache_key}.body'))
+
+
+def http_get(url, params=None, ttl=HTTP_CACHE_TTL):
+    (meta_path, body_path) = http_cache_paths(url, params)
+
+    cache_meta = None
+    if meta_path.exists() and body_path.exists():
+        with open(meta_path) as fhandle:
+            cache_meta = json.loads(fhandle.read())
+
+        if time() - cache_meta['fetched'] < ttl:
+            return body_path.read_bytes()
+
+    headers = {}
+    if cache_meta and cache_meta.get('etag'):
+        headers['If-None-Match'] = cache_meta['etag']
+    if cache_meta and cache_meta.get('last_modified'):
+        headers['If-Modified-Since'] = cache_meta['last_modified']
+
+    response = HTTP_SESSION.get(url, params=params, headers=headers, timeout=HTTP_TIMEOUT)
+    if response.status_code == 304 and cache_meta:
+        cache_meta['fetched'] = time()
+        write_http_cache(meta_path, cache_meta)
+        return body_path.read_bytes()
 
+    if response.status_code == 200:
+        HTTP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        body_tmp_path = body_path.with_suffix(f'.{threading.get_ident()}.tmp')
+        body_tmp_path.write_bytes(response.content)
+        os.replace(body_tmp_path, body_path)
+        write_http_cache(meta_path, {
+            'url': url,
+            'fetched': time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        })
 
-def reset_steamcmd():
-    if Path('.').joinpath('steamcmd.exe').exists():
-        for folder_object in Path('.').iterdir():
-            if not folder_object.name in UNLINK_EXCLUDE:
-                if folder_object.is_file() or folder_object.is_symlink():
-                    folder_object.unlink()
-                elif folder_object.is_dir():
-                    shutil.rmtree(folder_object)
+    return response.content
+
+
+def http_post(url, data):
+    response = HTTP_SESSION.post(url, data=data, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+
+    return response.json()
+
+
+def write_http_cache(meta_path, cache_meta):
+    meta_tmp_path = meta_path.with_suffix(f'.{threading.get_ident()}.tmp')
+    with open(meta_tmp_path, 'w') as fhandle:
+        fhandle.write(json.dumps(cache_meta))
+    os.replace(meta_tmp_path, meta_path)
+
+
+def evict_http_cache(max_age=HTTP_CACHE_MAX_AGE):
+    if not HTTP_CACHE_DIR.exists():
+        return
+
+    for meta_path in HTTP_CACHE_DIR.glob('*.json'):
+        try:
+            with open(meta_path) as fhandle:
+                fetched = json.loads(fhandle.read())['fetched']
+        except (OSError, ValueError, KeyError):
+            fetched = 0
+
+        if time() - fetched > max_age:
+            meta_path.unlink(missing_ok=True)
+            meta_path.with_suffix('.body').unlink(missing_ok=True)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds % 3600 // 60:02}:{seconds % 60:02}'
 
 
 def format_bytes(bytes):
@@ -87,12 +333,49 @@ def format_bytes(bytes):
         bytes = bytes / 1000
 
 
-def ensure_telegram_connection():
-    if Path(f'{SESSION_NAME}.session').exists():
+class TelegramLoop:
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self.thread.start()
+
+        return self.loop
+
+    def run(self, coroutine):
+        # a client only reads its connection on the loop it was started on, every thread hands its calls to that loop
+        if threading.current_thread() is self.thread:
+            raise Exception('Telegram calls on the telegram loop must be awaited')
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.start()).result()
+
+    def call(self, method, *args, **kwargs):
+        async def call_method():
+            return await method(*args, **kwargs)
+
+        return self.run(call_method())
+
+
+TELEGRAM_LOOP = TelegramLoop()
+
+
+async def start_telegram_client(session_name, api_id=None, api_hash=None):
+    app = Client(session_name, api_id, api_hash)
+    await app.start()
+
+    return app
+
+
+def ensure_telegram_connection(session_name=SESSION_NAME):
+    if Path(f'{session_name}.session').exists():
         try:
-            app = Client(SESSION_NAME)
-            app.start()
-            return app
+            return TELEGRAM_LOOP.run(start_telegram_client(session_name))
         except:
             raise Exception('Delete Session file and try again.')
 
@@ -101,248 +384,2180 @@ def ensure_telegram_connection():
             api_id = int(input('Enter your api_id: '))
             api_hash = input('Enter your api_hash: ')
 
-            app = Client(SESSION_NAME, api_id, api_hash)
-            app.start()
-            return app
+            return TELEGRAM_LOOP.run(start_telegram_client(session_name, api_id, api_hash))
         except:
             print('\nError. Try again.\n')
             pass
 
 
+def parse_workshop_input(user_input):
+    user_input = user_input.strip()
+    if f'{STEAM_URL}?id=' in user_input:
+        return user_input.split(f'{STEAM_URL}?id=')[1]
+    elif f'{STEAM_URL}/changelog/' in user_input:
+        return user_input.split(f'{STEAM_URL}/changelog/')[1]
+    elif len(user_input) == 10 and user_input.isdigit():
+        return user_input
+
+
+def is_steam_page_node(name, attrs):
+    attrs = attrs or {}
+    classes = attrs.get('class') or ''
+    if isinstance(classes, str):
+        classes = classes.split()
+
+    if name == 'div':
+        return attrs.get('id') == 'highlight_player_area' or any(c in STEAM_PAGE_CLASSES for c in classes)
+    elif name == 'img':
+        return attrs.get('id') in ('previewImageMain', 'previewImage')
+
+    return False
+
+
+class SteamPageStrainer(SoupStrainer):
+    # only matching top level tags and their children end up in the tree
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return is_steam_page_node(name, attrs)
+
+    def allow_string_creation(self, string):
+        return False
+
+    # bs4 < 4.13
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        if is_steam_page_node(markup_name, markup_attrs):
+            return markup_name
+
+
+STEAM_PAGE_STRAINER = SteamPageStrainer()
+
+
+def parse_steam_html(html_content, html_extractor=None):
+    html_extractor = html_extractor or HTML_EXTRACTOR
+    if html_extractor == 'full':
+        return BeautifulSoup(html_content, 'html.parser')
+    elif html_extractor == 'lxml':
+        return BeautifulSoup(html_content, 'lxml', parse_only=STEAM_PAGE_STRAINER)
+
+    return BeautifulSoup(html_content, 'html.parser', parse_only=STEAM_PAGE_STRAINER)
+
+
+def fetch_steam_page(workshop_id):
+    html_content = http_get(STEAM_URL, params={ 'id': workshop_id })
+    soup = parse_steam_html(html_content)
+    if not soup.css.select_one('div.error_ctn'):
+        return soup
+
+
+def fetch_changelog_page(workshop_id):
+    changelog_content = http_get(f'{STEAM_URL}changelog/{workshop_id}')
+    return parse_steam_html(changelog_content)
+
+
+def benchmark_html_extractors(page_paths, rounds=5):
+    for page_path in page_paths:
+        html_content = Path(page_path).read_bytes()
+        reference_nodes = None
+        for html_extractor in HTML_EXTRACTORS:
+            try:
+                parse_steam_html(html_content, html_extractor)
+            except FeatureNotFound:
+                print(f'{Path(page_path).name} - {html_extractor}: parser not installed')
+                continue
+
+            tracemalloc.start()
+            start = perf_counter()
+            for _ in range(rounds):
+                soup = parse_steam_html(html_content, html_extractor)
+            parse_time = (perf_counter() - start) / rounds
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            page_nodes = [str(soup.css.select_one(selector)) for selector in STEAM_PAGE_SELECTORS]
+            if reference_nodes is None:
+                reference_nodes = page_nodes
+                check = 'reference'
+            else:
+                mismatches = [selector for selector, a, b in zip(STEAM_PAGE_SELECTORS, reference_nodes, page_nodes) if a != b]
+                check = 'same nodes' if not mismatches else f'MISMATCH in {", ".join(mismatches)}'
+
+            print(f'{Path(page_path).name} - {html_extractor}: {parse_time * 1000:0.1f}ms per parse, peak {format_bytes(peak_memory)}, {check}')
+
+
 def ask_for_steam_input():
     while True:
-        user_input = input('SteamID | SteamURL: ')
-        if f'{STEAM_URL}?id=' in user_input:
-            workshop_id = user_input.split(f'{STEAM_URL}?id=')[1]
-        elif f'{STEAM_URL}/changelog/' in user_input:
-            workshop_id = user_input.split(f'{STEAM_URL}/changelog/')[1]
-        elif len(user_input) == 10 and user_input.isdigit():
-            workshop_id = user_input
-        else:
+        workshop_id = parse_workshop_input(input('SteamID | SteamURL: '))
+        if not workshop_id:
             print('Invalid input. Try again')
             continue
 
-        html_content = requests.get(STEAM_URL, params={ 'id': workshop_id }).content
-        soup = BeautifulSoup(html_content, 'html.parser')
-        if not soup.css.select_one('div.error_ctn'):
+        soup = fetch_steam_page(workshop_id)
+        if soup:
             return (workshop_id, soup)
         else:
             print('Invalid SteamID. Try again')
 
 
-def ask_for_telegram_input(tg_client):
-    while True:
-        user_input = input('Telegram channel id: ')
-        try:
-            user_input = int(user_input)
-        except ValueError:
-            print('Invalid chat id. Try again')
-            continue
-        
+async def get_telegram_channel(tg_client, chat_id):
+    try:
+        chat = await tg_client.get_chat(chat_id)
+    except ValueError:
+        raise Exception('You have not joined this chat')
+    except PeerIdInvalid:
+        raise Exception('Inexistent chat id')
+
+    if not chat.type == ChatType.CHANNEL:
+        raise Exception('Provided id is not from a channel')
+    elif not chat.linked_chat:
+        raise Exception('Channel doesn\'t have a linked chat for comments')
+
+    return chat
+
+
+def ask_for_telegram_input(tg_client):
+    while True:
+        user_input = input('Telegram channel id (comma separated to post to several): ')
+        try:
+            channel_ids = [int(channel_id) for channel_id in user_input.split(',')]
+        except ValueError:
+            print('Invalid chat id. Try again')
+            continue
+        
+        try:
+            chats = [TELEGRAM_LOOP.run(get_telegram_channel(tg_client, channel_id)) for channel_id in channel_ids]
+        except Exception as e:
+            print(f'{e}. Try again')
+            continue
+
+        for chat in chats:
+            print(f'Will upload to \'{chat.title}\' and \'{chat.linked_chat.title}\'')
+        return channel_ids
+
+
+def get_archive_dir(workshop_id):
+    return CACHE_DIR.joinpath(workshop_id)
+
+
+def clear_archive_dir(workshop_id):
+    map_cachedir = get_archive_dir(workshop_id)
+    map_cachedir.mkdir(parents=True, exist_ok=True)
+    for map_cachedir_object in map_cachedir.iterdir():
+        if map_cachedir_object.is_file() or map_cachedir_object.is_symlink():
+            map_cachedir_object.unlink()
+        elif map_cachedir_object.is_dir():
+            shutil.rmtree(map_cachedir_object, ignore_errors=True)
+
+    return map_cachedir
+
+
+class JobStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = None
+        self.lock = threading.RLock()
+
+    def connect(self):
+        with self.lock:
+            if self.connection is None:
+                self.db_path.parent.mkdir(parents=True, exist_ok=True)
+                self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+                self.connection.row_factory = sqlite3.Row
+                self.connection.execute('PRAGMA journal_mode=WAL')
+                with self.connection:
+                    self.connection.executescript(JOB_STORE_SCHEMA)
+
+                if CACHE_INDEX_PATH.exists():
+                    import_json_cache(self)
+
+            return self.connection
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            connection = self.connect()
+            # commits on success and rolls back every statement of the block on an exception
+            with connection:
+                yield connection
+
+    def row_to_job(self, row):
+        job = dict(row)
+        job['data'] = json.loads(job['data'])
+
+        return job
+
+    def get(self, workshop_id):
+        with self.transaction() as connection:
+            row = connection.execute('SELECT * FROM jobs WHERE workshop_id = ?', (workshop_id,)).fetchone()
+
+        return self.row_to_job(row) if row else None
+
+    def update(self, workshop_id, state=None, data=None, **fields):
+        if state is not None and not state in JOB_STATES:
+            raise Exception(f'Unknown job state \'{state}\'')
+
+        with self.transaction() as connection:
+            row = connection.execute('SELECT state, data FROM jobs WHERE workshop_id = ?', (workshop_id,)).fetchone()
+            if row is None:
+                connection.execute('INSERT INTO jobs (workshop_id, state, updated_at) VALUES (?, ?, ?)', (workshop_id, state or 'queued', time()))
+
+            if state is not None:
+                fields['state'] = state
+            if data is not None:
+                fields['data'] = json.dumps({**(json.loads(row['data']) if row else {}), **data})
+            fields['updated_at'] = time()
+
+            connection.execute(
+                'UPDATE jobs SET {} WHERE workshop_id = ?'.format(', '.join(f'{field} = ?' for field in fields)),
+                (*fields.values(), workshop_id)
+            )
+
+    def get_post(self, workshop_id, channel):
+        with self.transaction() as connection:
+            row = connection.execute('SELECT * FROM posts WHERE workshop_id = ? AND channel = ?', (workshop_id, str(channel))).fetchone()
+
+        if not row:
+            return None
+
+        post = dict(row)
+        post['sent_files'] = json.loads(post['sent_files'])
+        return post
+
+    def update_post(self, workshop_id, channel, state=None, **fields):
+        if state is not None and not state in JOB_STATES:
+            raise Exception(f'Unknown job state \'{state}\'')
+
+        with self.transaction() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO posts (workshop_id, channel, state, updated_at) VALUES (?, ?, ?, ?)',
+                (workshop_id, str(channel), state or 'posted', time())
+            )
+
+            if state is not None:
+                fields['state'] = state
+            fields['updated_at'] = time()
+
+            connection.execute(
+                'UPDATE posts SET {} WHERE workshop_id = ? AND channel = ?'.format(', '.join(f'{field} = ?' for field in fields)),
+                (*fields.values(), workshop_id, str(channel))
+            )
+
+    def add_sent_files(self, workshop_id, channel, file_names, files_msg_id):
+        with self.transaction() as connection:
+            row = connection.execute('SELECT sent_files, files_msg_id FROM posts WHERE workshop_id = ? AND channel = ?', (workshop_id, str(channel))).fetchone()
+            connection.execute(
+                'UPDATE posts SET sent_files = ?, files_msg_id = ?, updated_at = ? WHERE workshop_id = ? AND channel = ?',
+                (json.dumps(json.loads(row['sent_files']) + file_names), row['files_msg_id'] or files_msg_id, time(), workshop_id, str(channel))
+            )
+
+    def clear_finished_posts(self, workshop_id):
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM posts WHERE workshop_id = ? AND state = ?', (workshop_id, 'done'))
+
+    def post_channels(self, workshop_id):
+        with self.transaction() as connection:
+            rows = connection.execute('SELECT channel FROM posts WHERE workshop_id = ? AND post_msg_id IS NOT NULL', (workshop_id,)).fetchall()
+
+        return [int(row['channel']) for row in rows]
+
+    def posted(self):
+        with self.transaction() as connection:
+            rows = connection.execute('SELECT DISTINCT workshop_id FROM posts WHERE post_msg_id IS NOT NULL ORDER BY workshop_id').fetchall()
+
+        return [row['workshop_id'] for row in rows]
+
+    def reopen_posts(self, workshop_id):
+        # an updated item keeps its posts, they are resumed to send the new files and edit the caption
+        with self.transaction() as connection:
+            connection.execute('UPDATE jobs SET state = ?, updated_at = ? WHERE workshop_id = ?', ('queued', time(), workshop_id))
+            connection.execute(
+                'UPDATE posts SET state = ?, files_msg_id = NULL, sent_files = ?, updated_at = ? WHERE workshop_id = ?',
+                ('posted', '[]', time(), workshop_id)
+            )
+
+    def restart_post_files(self, workshop_id):
+        # a new archive is sent whole in the posts that did not finish, volumes of the old one can't be mixed with it
+        with self.transaction() as connection:
+            connection.execute(
+                'UPDATE posts SET state = ?, files_msg_id = NULL, sent_files = ?, updated_at = ? WHERE workshop_id = ? AND NOT state = ?',
+                ('posted', '[]', time(), workshop_id, 'done')
+            )
+
+    def evictable(self):
+        # posted items, the ones not reused for the longest time first
+        with self.transaction() as connection:
+            rows = connection.execute('SELECT workshop_id FROM jobs WHERE state = ? ORDER BY updated_at', ('done',)).fetchall()
+
+        return [row['workshop_id'] for row in rows]
+
+    def pending(self):
+        with self.transaction() as connection:
+            rows = connection.execute(
+                'SELECT * FROM jobs WHERE state IN ({}) ORDER BY updated_at'.format(', '.join('?' * len(JOB_PENDING_STATES))),
+                JOB_PENDING_STATES
+            ).fetchall()
+
+        # a job interrupted while streaming has no complete archive to resume from, it has to be packaged again
+        return [job for job in map(self.row_to_job, rows) if not job['data'].get('streaming')]
+
+
+JOB_STORE = JobStore(CACHE_DIR.joinpath('jobs.db'))
+
+
+def import_json_cache(job_store):
+    # one time move of the index.json cache of older versions into the job store
+    with open(CACHE_INDEX_PATH) as fhandle:
+        cache_index = json.loads(fhandle.read())
+
+    for content_path in CACHE_DIR.iterdir():
+        cache_json_path = content_path.joinpath(f'{content_path.name}.json')
+        if not content_path.is_dir() or not cache_json_path.exists():
+            continue
+
+        with open(cache_json_path) as fhandle:
+            content_json = json.loads(fhandle.read())
+
+        index_entry = cache_index.get(content_path.name, {})
+        job_store.update(
+            content_path.name,
+            'done' if index_entry.get('posted') else 'packaged',
+            content_json,
+            time_updated=content_json.get('time_updated')
+        )
+        cache_json_path.unlink()
+
+    os.replace(CACHE_INDEX_PATH, CACHE_INDEX_PATH.with_suffix('.json.imported'))
+
+
+def cache_content(content_json, state='packaged'):
+    # archives are already written into the cache dir, only the metadata is left to store
+    get_archive_dir(content_json['PublisherID']).mkdir(parents=True, exist_ok=True)
+    # new archives make the documents uploaded for older ones useless
+    JOB_STORE.update(content_json['PublisherID'], state, {'documents': {}, **content_json}, time_updated=content_json.get('time_updated'))
+
+
+def reuse_unchanged_cache(workshop_id, scrape_data):
+    cached_json = get_unchanged_cache(workshop_id, scrape_data.get('time_updated'))
+    if not cached_json:
+        return None
+
+    print(f'{workshop_id} has not changed since it was cached. Reusing cached files')
+    workshop_json = {**cached_json, **scrape_data}
+    JOB_STORE.update(workshop_id, data=workshop_json)
+
+    return workshop_json
+
+
+def get_unchanged_cache(workshop_id, time_updated):
+    job = JOB_STORE.get(workshop_id)
+    if not job or not time_updated or not job['time_updated'] == time_updated or not job['data'].get('rar_files') or job['data'].get('streaming'):
+        return None
+
+    if job['data'].get('patch') and job['state'] == 'done':
+        # a posted patch is only useful in the posts it updated, anything else needs the full archive
+        return None
+
+    map_cachedir = get_archive_dir(workshop_id)
+    if not all(map_cachedir.joinpath(rar).exists() for rar in job['data']['rar_files']):
+        return None
+
+    return job['data']
+
+
+class DiskBudget:
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.reservations = {}
+        self.staged = {}
+        self.held = set()
+        self.condition = threading.Condition()
+
+    def usage(self):
+        # the content, staged files and archives of admitted items are counted by their reservations
+        reserved_names = set(self.reservations) | {self.staged[workshop_id] for workshop_id in self.reservations if workshop_id in self.staged}
+        used_bytes = 0
+        if CACHE_DIR.exists():
+            for item_path in CACHE_DIR.iterdir():
+                if item_path.is_dir() and item_path.name.isdigit() and not item_path.name in reserved_names:
+                    used_bytes += directory_size(item_path)
+
+        if GAME_CONTENT_PATH.exists():
+            # downloads are named by id and staged items by title, both take room until they are archived
+            for item_path in GAME_CONTENT_PATH.iterdir():
+                if item_path.is_dir() and not item_path.name in reserved_names:
+                    used_bytes += directory_size(item_path)
+
+        return used_bytes
+
+    def stage(self, workshop_id, norm_workshopname):
+        if self.budget is None:
+            return
+
+        with self.condition:
+            self.staged[workshop_id] = norm_workshopname
+
+    def hold(self, workshop_id):
+        # cached archives need no new room, they are only kept from eviction until they are posted
+        if self.budget is None:
+            return
+
+        with self.condition:
+            self.held.add(workshop_id)
+            if self.reservations.pop(workshop_id, None) is not None:
+                self.condition.notify_all()
+
+    def evict(self, needed_bytes):
+        for workshop_id in JOB_STORE.evictable():
+            archive_dir = get_archive_dir(workshop_id)
+            if needed_bytes <= 0:
+                break
+            if workshop_id in self.reservations or workshop_id in self.held or not archive_dir.exists():
+                continue
+
+            archive_bytes = directory_size(archive_dir)
+            shutil.rmtree(archive_dir, ignore_errors=True)
+            print(f'[Disk] Evicted the cached archives of {workshop_id} ({format_bytes(archive_bytes)})')
+            needed_bytes -= archive_bytes
+
+    def admit(self, workshop_id, item_bytes=None):
+        if self.budget is None:
+            return
+
+        footprint = item_bytes * DISK_FOOTPRINT_FACTOR if item_bytes else None
+        if footprint and footprint > self.budget:
+            raise Exception(f'{workshop_id} needs about {format_bytes(footprint)}, more than the {format_bytes(self.budget)} disk budget')
+
+        with self.condition:
+            waiting = False
+            while True:
+                if footprint is None:
+                    # an item of unknown size runs alone with whatever is left of the budget
+                    if not self.reservations:
+                        footprint = max(0, self.budget - self.usage())
+                        break
+                else:
+                    needed_bytes = self.usage() + sum(self.reservations.values()) + footprint - self.budget
+                    if needed_bytes > 0:
+                        self.evict(needed_bytes)
+                        needed_bytes = self.usage() + sum(self.reservations.values()) + footprint - self.budget
+                    if needed_bytes <= 0:
+                        break
+                    if not self.reservations:
+                        raise Exception(f'{workshop_id} needs about {format_bytes(footprint)} and the unposted items in the cache leave only {format_bytes(self.budget - self.usage())}')
+
+                if not waiting:
+                    print(f'[Disk] {workshop_id} waits for disk space')
+                    waiting = True
+                self.condition.wait()
+
+            self.reservations[workshop_id] = footprint
+
+    def release(self, workshop_id, failed=False):
+        if self.budget is None:
+            return
+
+        with self.condition:
+            self.held.discard(workshop_id)
+            norm_workshopname = self.staged.pop(workshop_id, None)
+            if self.reservations.pop(workshop_id, None) is None:
+                return
+
+            if failed:
+                # content left behind by a failed job would only shrink the budget
+                shutil.rmtree(GAME_CONTENT_PATH.joinpath(workshop_id), ignore_errors=True)
+                if norm_workshopname:
+                    shutil.rmtree(GAME_CONTENT_PATH.joinpath(norm_workshopname), ignore_errors=True)
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, workshop_id, item_bytes=None):
+        self.admit(workshop_id, item_bytes)
+        try:
+            yield
+        except Exception:
+            self.release(workshop_id, failed=True)
+            raise
+
+        self.release(workshop_id)
+
+
+DISK_BUDGET = DiskBudget()
+
+
+def parse_steamcmd_line(stdout_line):
+    item_match = STEAMCMD_ITEM_REGEX.search(stdout_line)
+    workshop_id = item_match.group(1) if item_match else None
+    for output in Outputs:
+        if output.value in stdout_line:
+            return (output, workshop_id)
+
+    return (None, workshop_id)
+
+
+def read_process_lines(process, lines):
+    for stdout_line in iter(process.stdout.readline, ""):
+        lines.put(stdout_line)
+    lines.put(None)
+
+
+def kill_process_tree(process):
+    if os.name == 'nt':
+        # the process is a shell, steamcmd.exe is its child
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+    else:
+        process.kill()
+    process.wait()
+
+
+def directory_size(path):
+    total_bytes = 0
+    pending = [path]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as dir_entries:
+                for dir_entry in dir_entries:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        pending.append(dir_entry.path)
+                    elif dir_entry.is_file(follow_symlinks=False):
+                        total_bytes += dir_entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            # steamcmd moves and deletes its chunk files while they are counted
+            continue
+
+    return total_bytes
+
+
+class DownloadWatchdog:
+    def __init__(self, stall_timeout, downloads_path=None, content_path=None):
+        self.stall_timeout = stall_timeout
+        self.downloads_path = downloads_path or GAME_DOWNLOADS_PATH
+        self.content_path = content_path or GAME_CONTENT_PATH
+        self.workshop_id = None
+
+    def watch(self, workshop_id):
+        self.workshop_id = workshop_id
+        self.started = perf_counter()
+        self.sampled_at = 0.0
+        self.progress_at = self.started
+        self.item_bytes = -1
+
+    def stop(self):
+        self.workshop_id = None
+
+    def sample(self):
+        # steamcmd writes chunks into the downloads folder and moves them into content when they are complete
+        return directory_size(self.downloads_path.joinpath(self.workshop_id)) + directory_size(self.content_path.joinpath(self.workshop_id))
+
+    def stalled(self):
+        if self.workshop_id is None or not self.stall_timeout:
+            return False
+
+        now = perf_counter()
+        if now - self.sampled_at < STEAMCMD_SAMPLE_INTERVAL:
+            return False
+
+        self.sampled_at = now
+        item_bytes = self.sample()
+        if not item_bytes == self.item_bytes:
+            speed = max(0, item_bytes - max(0, self.item_bytes)) / max(now - self.progress_at, 1e-6)
+            self.item_bytes = item_bytes
+            self.progress_at = now
+            PROGRESS.line('steamcmd-progress', f'[Downloading...] {self.workshop_id} - {format_bytes(item_bytes)} {format_bytes(speed)}/s')
+            return False
+
+        return now - self.progress_at >= self.stall_timeout
+
+
+class SteamcmdWorker:
+    def __init__(self, root_path):
+        self.root_path = root_path
+        self.content_path = root_path.joinpath('steamapps', 'workshop', 'content', '311210')
+        self.downloads_path = root_path.joinpath('steamapps', 'workshop', 'downloads', '311210')
+
+    def setup(self):
+        # every worker runs its own copy of steamcmd, which installs itself in the worker folder on the first run
+        self.root_path.mkdir(parents=True, exist_ok=True)
+        steamcmd_path = INITIAL_CWD.joinpath('steamcmd.exe')
+        if steamcmd_path.exists() and not self.root_path.joinpath('steamcmd.exe').exists():
+            shutil.copy2(steamcmd_path, self.root_path)
+
+    def reset(self, pending_ids=()):
+        for folder_object in self.root_path.iterdir():
+            if not folder_object.name == 'steamcmd.exe':
+                remove_steamcmd_object(folder_object, self.content_path, pending_ids)
+
+    def hand_over(self, workshop_id):
+        # the packaging reads finished items from the shared content folder
+        target_path = GAME_CONTENT_PATH.joinpath(workshop_id)
+        if target_path.exists():
+            shutil.rmtree(target_path)
+        move_file(self.content_path.joinpath(workshop_id), target_path)
+
+
+class SteamcmdPool:
+    def __init__(self, size=0):
+        self.size = size
+        self.workers = queue.Queue()
+        for i in range(size):
+            worker = SteamcmdWorker(STEAMCMD_WORKERS_DIR.joinpath(str(i + 1)))
+            worker.setup()
+            self.workers.put(worker)
+
+    @contextmanager
+    def acquire(self):
+        if not self.size:
+            # without workers every download goes through the steamcmd next to the script, one at a time
+            with STEAMCMD_LOCK:
+                yield None
+            return
+
+        worker = self.workers.get()
+        try:
+            yield worker
+        finally:
+            self.workers.put(worker)
+
+
+STEAMCMD_POOL = SteamcmdPool()
+
+
+def download_workshop_items(workshop_ids, worker=None):
+    pending = list(dict.fromkeys(workshop_ids))
+    downloaded = {}
+    failure_counts = {workshop_id: 0 for workshop_id in pending}
+    timeout_counts = {workshop_id: 0 for workshop_id in pending}
+    failed_ids = []
+    validate_ids = set()
+    resumed_ids = set()
+    reset_install = False
+    download_start = perf_counter()
+
+    def note_failure(workshop_id, timeout=True):
+        nonlocal reset_install
+        # a failed item is resumed first, validate re-hashes everything so it is only used when the resume fails too
+        failure_counts[workshop_id] += 1
+        if workshop_id in resumed_ids:
+            validate_ids.add(workshop_id)
+        else:
+            resumed_ids.add(workshop_id)
+
+        # steamcmd is reinstalled after an error or a few timeouts of an item, but only for the items still pending
+        if timeout:
+            timeout_counts[workshop_id] += 1
+        if not timeout or timeout_counts[workshop_id] >= STEAMCMD_RESET_TIMEOUTS:
+            reset_install = True
+
+        if failure_counts[workshop_id] >= STEAMCMD_MAX_FAILURES and workshop_id in pending:
+            print(f'{workshop_id} failed to download {failure_counts[workshop_id]} times. Skipping it')
+            pending.remove(workshop_id)
+            failed_ids.append(workshop_id)
+
+    while pending:
+        if reset_install:
+            # only the pending items are downloaded again, finished and staged items stay where they are
+            if worker:
+                worker.reset(pending)
+            else:
+                reset_steamcmd(pending)
+
+            timeout_counts = {workshop_id: 0 for workshop_id in timeout_counts}
+            resumed_ids = set()
+            validate_ids = set()
+            reset_install = False
+
+        steam_cmd = ['steamcmd.exe', '+login anonymous']
+        for workshop_id in pending:
+            if workshop_id in validate_ids:
+                steam_cmd.append('+workshop_download_item 311210 {} validate'.format(workshop_id))
+            else:
+                steam_cmd.append('+workshop_download_item 311210 {}'.format(workshop_id))
+        steam_cmd.append('+quit')
+        steam_popen = popen(steam_cmd, cwd=worker.root_path if worker else INITIAL_CWD)
+        steam_lines = queue.Queue()
+        threading.Thread(target=read_process_lines, args=(steam_popen, steam_lines), daemon=True).start()
+
+        validate_ids = set()
+        current_id = pending[0]
+        watchdog = DownloadWatchdog(STEAMCMD_STALL_TIMEOUT, *((worker.downloads_path, worker.content_path) if worker else ()))
+        stalled_id = None
+
+        while True:
+            try:
+                stdout_line = steam_lines.get(timeout=STEAMCMD_POLL_INTERVAL)
+            except queue.Empty:
+                stdout_line = ''
+
+            if stdout_line is None:
+                break
+
+            if stdout_line:
+                (output, workshop_id) = parse_steamcmd_line(stdout_line)
+                PROGRESS.line('steamcmd', stdout_line.rstrip(), force=output is not None)
+                if workshop_id in timeout_counts:
+                    current_id = workshop_id
+                else:
+                    workshop_id = current_id
+
+                if output == Outputs.DOWNLOAD_START:
+                    watchdog.watch(workshop_id)
+                elif output == Outputs.DOWNLOAD_TIMEOUT:
+                    watchdog.stop()
+                    note_failure(workshop_id)
+                elif output == Outputs.DOWNLOAD_FAILURE:
+                    watchdog.stop()
+                    note_failure(workshop_id, timeout=False)
+                elif output == Outputs.DOWNLOAD_SUCCESS and workshop_id in pending:
+                    watchdog.stop()
+                    bytes_match = STEAMCMD_BYTES_REGEX.search(stdout_line)
+                    downloaded[workshop_id] = int(bytes_match.group(1)) if bytes_match else None
+                    pending.remove(workshop_id)
+                    resumed_ids.discard(workshop_id)
+
+            if watchdog.stalled():
+                stalled_id = watchdog.workshop_id
+                print(f'{stalled_id} downloaded nothing for {STEAMCMD_STALL_TIMEOUT}s. Restarting steamcmd to resume it')
+                kill_process_tree(steam_popen)
+                break
+
+        PROGRESS.flush('steamcmd')
+
+        if stalled_id:
+            note_failure(stalled_id)
+            METRICS.add_retries('download', 1, items=[stalled_id], reason='stall')
+            continue
+
+        if not steam_popen.wait() == 0:
+            raise Exception('Error in steamcmd.exe termination')
+
+        if pending:
+            print(f'Retrying {len(pending)} item(s): {", ".join(pending)}')
+            METRICS.add_retries('download', len(pending), items=pending)
+
+    if failed_ids:
+        METRICS.record('download', 0, failed=True, items=failed_ids)
+
+    for workshop_id, content_bytes in downloaded.items():
+        if worker:
+            worker.hand_over(workshop_id)
+        if content_bytes is None:
+            downloaded[workshop_id] = manifest_size(build_manifest(GAME_CONTENT_PATH.joinpath(workshop_id)))
+
+    METRICS.record('download', perf_counter() - download_start, sum(downloaded.values()), items=list(downloaded))
+
+    return downloaded
+
+
+def download_workshop_item(workshop_id, worker=None):
+    downloaded = download_workshop_items([workshop_id], worker)
+    if not workshop_id in downloaded:
+        raise Exception(f'Could not download {workshop_id}')
+
+    return downloaded[workshop_id]
+
+
+def hash_file(file_path):
+    file_hash = hashlib.sha1()
+    with open(file_path, 'rb') as fhandle:
+        for chunk in iter(lambda: fhandle.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def build_manifest(root_path, with_hashes=False):
+    manifest = {}
+    pending = [(root_path, '')]
+    while pending:
+        (dir_path, prefix) = pending.pop()
+        with os.scandir(dir_path) as dir_entries:
+            for dir_entry in dir_entries:
+                relative_path = prefix + dir_entry.name
+                if dir_entry.is_dir(follow_symlinks=False):
+                    pending.append((dir_entry.path, relative_path + '/'))
+                elif dir_entry.is_file(follow_symlinks=False):
+                    # on Windows the stat comes with the directory listing, no extra call per file
+                    entry_stat = dir_entry.stat(follow_symlinks=False)
+                    manifest[relative_path] = {'size': entry_stat.st_size, 'mtime': entry_stat.st_mtime}
+                    if with_hashes:
+                        manifest[relative_path]['sha1'] = hash_file(dir_entry.path)
+
+    return dict(sorted(manifest.items()))
+
+
+def manifest_size(manifest):
+    return sum(file_entry['size'] for file_entry in manifest.values())
+
+
+def manifest_langs(manifest):
+    supported_langs = {l: False for l in ALL_LANGS}
+    for relative_path in manifest:
+        top_level_name = relative_path.split('/')[0]
+        for lang in ALL_LANGS:
+            if f'{lang}_' in top_level_name:
+                supported_langs[lang] = True
+
+    return supported_langs
+
+
+def existing_parent(path):
+    while not path.exists():
+        path = path.parent
+
+    return path
+
+
+def check_staging(item_path, stage_path, archive_dir, content_bytes):
+    item_device = item_path.stat().st_dev
+    stage_device = existing_parent(stage_path).stat().st_dev
+    archive_device = existing_parent(archive_dir).stat().st_dev
+
+    needed_bytes = {archive_device: content_bytes}
+    if not stage_device == item_device:
+        print(f'Warning: {stage_path} is on another drive than {item_path}, the content will be copied instead of renamed')
+        needed_bytes[stage_device] = needed_bytes.get(stage_device, 0) + content_bytes
+
+    for device, device_bytes in needed_bytes.items():
+        device_path = existing_parent(archive_dir) if device == archive_device else existing_parent(stage_path)
+        free_bytes = shutil.disk_usage(device_path).free
+        if free_bytes < device_bytes + STAGING_FREE_SPACE_MARGIN:
+            raise Exception(f'Not enough free space on {device_path.anchor or device_path}: {format_bytes(free_bytes)} free, {format_bytes(device_bytes)} needed')
+
+
+def move_file(source_path, target_path):
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.replace(source_path, target_path)
+    except OSError:
+        # another drive, the only case where the bytes have to be copied
+        shutil.move(source_path, target_path)
+
+
+def stage_directory(source_path, target_path, manifest, partial=False):
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    if partial:
+        # only the files of a patch are staged, the rest of the download is dropped
+        target_path.mkdir(exist_ok=True)
+    elif not target_path.exists():
+        try:
+            source_path.rename(target_path)
+            return
+        except OSError:
+            pass
+
+    for relative_path in manifest:
+        move_file(source_path.joinpath(relative_path), target_path.joinpath(relative_path))
+    shutil.rmtree(source_path)
+
+
+def diff_manifests(base_manifest, manifest):
+    changed_manifest = {
+        relative_path: entry for relative_path, entry in manifest.items()
+        if not relative_path in base_manifest
+        or not base_manifest[relative_path]['size'] == entry['size']
+        or not base_manifest[relative_path]['sha1'] == entry['sha1']
+    }
+    deleted_files = sorted(set(base_manifest) - set(manifest))
+
+    return (changed_manifest, deleted_files)
+
+
+def get_patch_base(workshop_id):
+    job = JOB_STORE.get(workshop_id)
+    if not job or not job['data'].get('telegram_links'):
+        return None
+
+    # patches are always made against the last full archive, so the latest patch alone brings it up to date
+    base = job['data'].get('base') or {field: job['data'].get(field) for field in ('manifest', 'date_string', 'telegram_links')}
+    if not base['manifest'] or not all('sha1' in entry for entry in base['manifest'].values()):
+        print(f'{workshop_id} has no file hashes for its posted version. Packaging the full archive')
+        return None
+
+    return base
+
+
+def prepare_workshop_item(workshop_id, make_patch=False):
+    item_path = GAME_CONTENT_PATH.joinpath(workshop_id)
+    files_json = {}
+    with open(item_path.joinpath('workshop.json')) as fhandle:
+        files_json = json.loads(fhandle.read())
+
+    if not files_json:
+        raise Exception('Could not load workshop.json')
+
+    norm_workshopname = re.sub('[^A-Za-z0-9]+', '_', files_json['Title'])
+    files_json['PublisherID'] = workshop_id
+    # patches compare hashes, the file times of a new download are always new
+    files_json['manifest'] = build_manifest(item_path, MANIFEST_HASHES or make_patch)
+    files_json['content_bytes'] = manifest_size(files_json['manifest'])
+    files_json['content_size'] = format_bytes(files_json['content_bytes'])
+    files_json['base'] = None
+    files_json['patch'] = None
+    mapfiles_path = Path(norm_workshopname, files_json['FolderName'])
+
+    base = get_patch_base(workshop_id) if make_patch else None
+    archive_manifest = files_json['manifest']
+    if base:
+        (archive_manifest, deleted_files) = diff_manifests(base['manifest'], files_json['manifest'])
+        files_json['base'] = base
+        files_json['patch'] = {
+            'manifest': archive_manifest,
+            'deleted': deleted_files,
+            'size': format_bytes(manifest_size(archive_manifest)),
+        }
+        print(f'Patch of {workshop_id}: {len(archive_manifest)} changed and {len(deleted_files)} deleted file(s), {files_json["patch"]["size"]}')
+
+
+    supported_langs = manifest_langs(files_json['manifest'])
+
+    files_json['supported_langs'] = supported_langs
+    print(ALL_LANGS, supported_langs, sep='\n')
+
+
+    stage_path = GAME_CONTENT_PATH.joinpath(mapfiles_path, 'zone')
+    DISK_BUDGET.stage(workshop_id, norm_workshopname)
+    check_staging(item_path, stage_path, get_archive_dir(workshop_id), manifest_size(archive_manifest))
+    clear_archive_dir(workshop_id)
+    stage_directory(item_path, stage_path, archive_manifest, partial=base is not None)
+
+    return (files_json, norm_workshopname)
+
+
+def print_process_output(process):
+    for stdout_line in iter(process.stdout.readline, ""):
+        PROGRESS.line(process.pid, stdout_line.rstrip())
+    PROGRESS.flush(process.pid)
+
+
+def sample_compression_ratio(file_path):
+    file_size = file_path.stat().st_size
+    sample = b''
+    with open(file_path, 'rb') as fhandle:
+        for i in range(ARCHIVE_SAMPLE_COUNT):
+            fhandle.seek(max(0, file_size - ARCHIVE_SAMPLE_SIZE) * i // max(1, ARCHIVE_SAMPLE_COUNT - 1))
+            sample += fhandle.read(ARCHIVE_SAMPLE_SIZE)
+
+    if not sample:
+        return 1.0
+
+    return len(sample) / len(zlib.compress(sample, 1))
+
+
+def parse_type_level(entry):
+    (suffix, _, level) = entry.partition('=')
+    if not suffix.strip('.') or not level.isdigit():
+        raise argparse.ArgumentTypeError(f'\'{entry}\' is not EXT=LEVEL')
+
+    return ('.' + suffix.strip('.').lower(), int(level))
+
+
+def plan_compression(source_path, manifest, type_levels=ARCHIVE_TYPE_LEVELS, store_ratio=ARCHIVE_STORE_RATIO):
+    # None keeps the archiver default level, 0 stores the file as is
+    compression_plan = {}
+    for relative_path, file_entry in manifest.items():
+        file_path = source_path.joinpath(relative_path)
+        level = type_levels.get(file_path.suffix.lower())
+        if level is None and file_entry['size'] >= ARCHIVE_SAMPLE_SIZE:
+            if sample_compression_ratio(file_path) < store_ratio:
+                level = 0
+
+        compression_plan[file_path] = level
+
+    return compression_plan
+
+
+def stored_bytes_share(compression_plan):
+    total_bytes = sum(file_path.stat().st_size for file_path in compression_plan)
+    stored_bytes = sum(file_path.stat().st_size for file_path, level in compression_plan.items() if level == 0)
+
+    return stored_bytes / total_bytes if total_bytes else 0.0
+
+
+class ArchiveThread(threading.Thread):
+    def __init__(self, target):
+        super().__init__(daemon=True)
+        self.target = target
+        self.error = None
+        self.returncode = None
+
+    def run(self):
+        try:
+            self.target()
+            self.returncode = 0
+        except Exception as e:
+            print(f'[Archive] Error: {e}')
+            self.error = e
+            self.returncode = 1
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise self.error
+
+        return self.returncode
+
+
+class VolumeWriter:
+    def __init__(self, base_path, volume_size=ARCHIVE_VOLUME_SIZE):
+        self.base_path = base_path
+        self.volume_size = volume_size
+        self.volume = 0
+        self.written = 0
+        self.fhandle = None
+
+    def next_volume(self):
+        if self.fhandle:
+            self.fhandle.close()
+
+        self.volume += 1
+        self.written = 0
+        self.fhandle = open(f'{self.base_path}.{self.volume:03}', 'wb')
+
+    def write(self, data):
+        data = memoryview(data)
+        data_size = len(data)
+        while len(data):
+            if self.fhandle is None or self.written >= self.volume_size:
+                self.next_volume()
+
+            chunk_size = min(len(data), self.volume_size - self.written)
+            self.fhandle.write(data[:chunk_size])
+            self.written += chunk_size
+            data = data[chunk_size:]
+
+        return data_size
+
+    def flush(self):
+        if self.fhandle:
+            self.fhandle.flush()
+
+    def close(self):
+        if self.fhandle:
+            self.fhandle.close()
+            self.fhandle = None
+
+
+def deflate_block(block, level, dictionary=b'', last=True):
+    if level == 0:
+        return block
+
+    # a sync flush ends the block on a byte boundary, so the blocks deflated apart are one deflate stream once joined
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ZipStreamWriter:
+    def __init__(self, fhandle, threads=1, comment=b''):
+        self.fhandle = fhandle
+        self.threads = max(1, threads)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.comment = comment
+        self.offset = 0
+        self.entries = []
+
+    def write(self, data):
+        self.fhandle.write(data)
+        self.offset += len(data)
+
+    def compress_blocks(self, fhandle, file_size, level):
+        # zipfile deflates in the writing thread, here the blocks of a file are deflated by every thread like pigz does
+        block_count = max(1, ceil(file_size / ZIP_BLOCK_SIZE))
+        pending_blocks = deque()
+        dictionary = b''
+        for block_number in range(block_count):
+            block = fhandle.read(ZIP_BLOCK_SIZE)
+            pending_blocks.append((block, self.executor.submit(deflate_block, block, level, dictionary, block_number == block_count - 1)))
+            dictionary = block[-ZIP_DICTIONARY_SIZE:]
+
+            if len(pending_blocks) > self.threads * 2:
+                (block, future) = pending_blocks.popleft()
+                yield (block, future.result())
+
+        while pending_blocks:
+            (block, future) = pending_blocks.popleft()
+            yield (block, future.result())
+
+    def add(self, file_path, archive_name, level):
+        archive_name = archive_name.encode()
+        modified = datetime.fromtimestamp(file_path.stat().st_mtime)
+        dos_time = (modified.hour << 11) | (modified.minute << 5) | (modified.second // 2)
+        dos_date = ((max(modified.year, 1980) - 1980) << 9) | (modified.month << 5) | modified.day
+        method = zipfile.ZIP_STORED if level == 0 else zipfile.ZIP_DEFLATED
+        header_offset = self.offset
+
+        # the volumes are written front to back, crc and zip64 sizes follow the data in a descriptor
+        self.write(
+            struct.pack('<4s5H3L2H', b'PK\x03\x04', 45, 0x808, method, dos_time, dos_date, 0, 0xFFFFFFFF, 0xFFFFFFFF, len(archive_name), 20)
+            + archive_name
+            + struct.pack('<2H2Q', 1, 16, 0, 0)
+        )
+
+        crc = 0
+        file_size = 0
+        data_offset = self.offset
+        with open(file_path, 'rb') as fhandle:
+            for (block, compressed_block) in self.compress_blocks(fhandle, file_path.stat().st_size, level):
+                crc = zlib.crc32(block, crc)
+                file_size += len(block)
+                self.write(compressed_block)
+        compressed_size = self.offset - data_offset
+
+        self.write(struct.pack('<4sL2Q', b'PK\x07\x08', crc, compressed_size, file_size))
+        self.entries.append((archive_name, method, dos_time, dos_date, crc, compressed_size, file_size, header_offset))
+
+    def close(self):
+        self.executor.shutdown()
+
+        directory_offset = self.offset
+        for (archive_name, method, dos_time, dos_date, crc, compressed_size, file_size, header_offset) in self.entries:
+            self.write(
+                struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 45, 45, 0x808, method, dos_time, dos_date, crc, 0xFFFFFFFF, 0xFFFFFFFF, len(archive_name), 28, 0, 0, 0, 0, 0xFFFFFFFF)
+                + archive_name
+                + struct.pack('<2H3Q', 1, 24, file_size, compressed_size, header_offset)
+            )
+        directory_size = self.offset - directory_offset
+
+        zip64_offset = self.offset
+        self.write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, len(self.entries), len(self.entries), directory_size, directory_offset))
+        self.write(struct.pack('<4sLQL', b'PK\x06\x07', 0, zip64_offset, 1))
+        self.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, len(self.comment)) + self.comment)
+
+
+class Archiver:
+    name = None
+    extension = None
+    default_level = None
+    levels = range(0, 10)
+    streamable = True
+
+    def __init__(self, threads=ARCHIVE_THREADS, level=None, type_levels=ARCHIVE_TYPE_LEVELS):
+        self.threads = max(1, threads)
+        self.level = self.default_level if level is None else level
+        self.type_levels = type_levels
+
+    def available(self):
+        return True
+
+    def archive_name(self, files_json, norm_workshopname):
+        if files_json.get('patch'):
+            return '[T7] {} patch ({}){}'.format(norm_workshopname, files_json['patch']['size'], self.extension)
+
+        return '[T7] {} ({}){}'.format(norm_workshopname, files_json['content_size'], self.extension)
+
+    def archive_path(self, files_json, norm_workshopname):
+        return get_archive_dir(files_json['PublisherID']).joinpath(self.archive_name(files_json, norm_workshopname))
+
+    def volume_number(self, archive_path):
+        volume_match = re.search(r'\.(\d+)$', archive_path.name)
+        return int(volume_match.group(1)) if volume_match else 0
+
+    def is_volume(self, archive_path, norm_workshopname):
+        return (f'[T7] {norm_workshopname}') in archive_path.name and self.extension in archive_path.name
+
+    def archive_level(self, compression_plan):
+        # rar, 7z and zstd take one level for the whole archive, the highest one asked for a compressed file type
+        levels = {self.level if level is None else level for level in compression_plan.values() if not level == 0}
+        return max(levels) if levels else self.level
+
+    def write_archive(self, files_json, norm_workshopname):
+        raise Exception(f'Archiver \'{self.name}\' does not write archives itself')
+
+    def start(self, files_json, norm_workshopname):
+        # archivers written in python run in a thread that looks like an archiver process to the callers
+        archive_thread = ArchiveThread(lambda: self.write_archive(files_json, norm_workshopname))
+        archive_thread.start()
+
+        return archive_thread
+
+    def start_process(self, cmd):
+        archive_popen = popen(cmd, cwd=GAME_CONTENT_PATH)
+        threading.Thread(target=print_process_output, args=(archive_popen,), daemon=True).start()
+
+        return archive_popen
+
+
+class RarArchiver(Archiver):
+    name = 'rar'
+    extension = '.rar'
+    default_level = 3
+    levels = range(0, 6)
+
+    def executable(self):
+        if RAR_PATH.joinpath('Rar.exe').exists():
+            return RAR_PATH.joinpath('Rar.exe').resolve()
+
+        return shutil.which('rar')
+
+    def available(self):
+        return bool(self.executable())
+
+    def volume_number(self, archive_path):
+        volume_match = RAR_VOLUME_REGEX.search(archive_path.name)
+        return int(volume_match.group(1)) if volume_match else 0
+
+    def start(self, files_json, norm_workshopname):
+        mapfiles_path = Path(norm_workshopname, files_json['FolderName'])
+        compression_plan = plan_compression(GAME_CONTENT_PATH.joinpath(mapfiles_path, 'zone'), files_json['manifest'], self.type_levels)
+
+        # rar can only switch compression by file type, so a type is stored when all of its files are incompressible
+        suffixes = {file_path.suffix.lower() for file_path in compression_plan if file_path.suffix}
+        store_types = sorted(
+            suffix[1:] for suffix in suffixes
+            if all(level == 0 for file_path, level in compression_plan.items() if file_path.suffix.lower() == suffix)
+        )
+
+        cmd = [
+            self.executable(),
+            'a',
+            f'-v{ARCHIVE_VOLUME_SIZE // (1024 * 1024)}m',
+            f'-m{self.archive_level(compression_plan)}',
+            f'-mt{self.threads}',
+            '-z' + str(Path(norm_workshopname, RAR_COMMENT_FILENAME)),
+            '-df',
+        ]
+        if store_types:
+            cmd.append('-ms' + ';'.join(store_types))
+
+        return self.start_process(cmd + [
+            self.archive_path(files_json, norm_workshopname),
+            mapfiles_path,
+            Path(norm_workshopname, RAR_COMMENT_FILENAME),
+            '-ep1'
+        ])
+
+
+class SevenZipArchiver(Archiver):
+    name = '7z'
+    extension = '.7z'
+    default_level = 5
+    # 7z goes back to the first volume to write the archive header once every file is in
+    streamable = False
+
+    def executable(self):
+        if SEVENZIP_PATH.joinpath('7z.exe').exists():
+            return SEVENZIP_PATH.joinpath('7z.exe').resolve()
+
+        return shutil.which('7z') or shutil.which('7zz')
+
+    def available(self):
+        return bool(self.executable())
+
+    def start(self, files_json, norm_workshopname):
+        mapfiles_path = Path(norm_workshopname, files_json['FolderName'])
+        compression_plan = plan_compression(GAME_CONTENT_PATH.joinpath(mapfiles_path, 'zone'), files_json['manifest'], self.type_levels)
+
+        # 7z has a single level for the whole archive, store everything when most of it would not shrink
+        level = 0 if stored_bytes_share(compression_plan) >= 0.5 else self.archive_level(compression_plan)
+
+        return self.start_process([
+            self.executable(),
+            'a',
+            f'-v{ARCHIVE_VOLUME_SIZE // (1024 * 1024)}m',
+            f'-mx={level}',
+            f'-mmt={self.threads}',
+            '-sdel',
+            self.archive_path(files_json, norm_workshopname),
+            mapfiles_path,
+            Path(norm_workshopname, RAR_COMMENT_FILENAME),
+        ])
+
+
+class ZipArchiver(Archiver):
+    name = 'zip'
+    extension = '.zip'
+    default_level = 6
+
+    def write_archive(self, files_json, norm_workshopname):
+        source_path = GAME_CONTENT_PATH.joinpath(norm_workshopname)
+        compression_plan = plan_compression(source_path.joinpath(files_json['FolderName'], 'zone'), files_json['manifest'], self.type_levels)
+        volume_writer = VolumeWriter(self.archive_path(files_json, norm_workshopname))
+
+        archive = ZipStreamWriter(volume_writer, self.threads, RAR_COMMENT_CONTENTS.encode())
+        archive.add(source_path.joinpath(RAR_COMMENT_FILENAME), RAR_COMMENT_FILENAME, self.level)
+        for file_path, level in compression_plan.items():
+            print(f'[Archive] {file_path.relative_to(source_path)}')
+            archive.add(file_path, file_path.relative_to(source_path).as_posix(), self.level if level is None else level)
+        archive.close()
+        volume_writer.close()
+
+        shutil.rmtree(source_path)
+
+
+class TarZstdArchiver(Archiver):
+    name = 'tar.zst'
+    extension = '.tar.zst'
+    default_level = 3
+    levels = range(1, 23)
+
+    def available(self):
+        return zstandard is not None
+
+    def write_archive(self, files_json, norm_workshopname):
+        source_path = GAME_CONTENT_PATH.joinpath(norm_workshopname)
+        compression_plan = plan_compression(source_path.joinpath(files_json['FolderName'], 'zone'), files_json['manifest'], self.type_levels)
+
+        # a zstd stream has one level, incompressible blocks are stored raw by zstd itself
+        level = 1 if stored_bytes_share(compression_plan) >= 0.5 else self.archive_level(compression_plan)
+        compressor = zstandard.ZstdCompressor(level=level, threads=self.threads)
+        volume_writer = VolumeWriter(self.archive_path(files_json, norm_workshopname))
+
+        with compressor.stream_writer(volume_writer, closefd=False) as zstd_writer:
+            with tarfile.open(fileobj=zstd_writer, mode='w|') as archive:
+                archive.add(source_path.joinpath(RAR_COMMENT_FILENAME), RAR_COMMENT_FILENAME)
+                for file_path in compression_plan:
+                    print(f'[Archive] {file_path.relative_to(source_path)}')
+                    archive.add(file_path, file_path.relative_to(source_path).as_posix())
+        volume_writer.close()
+
+        shutil.rmtree(source_path)
+
+
+ARCHIVERS = {archiver.name: archiver for archiver in (RarArchiver, SevenZipArchiver, ZipArchiver, TarZstdArchiver)}
+
+
+def get_archiver(name=None, threads=ARCHIVE_THREADS, level=None, type_levels=ARCHIVE_TYPE_LEVELS):
+    if name is None:
+        name = 'rar' if RarArchiver().available() else 'zip'
+
+    if not name in ARCHIVERS:
+        raise Exception(f'Unknown archiver \'{name}\'')
+
+    archiver = ARCHIVERS[name](threads, level, type_levels)
+    if not archiver.available():
+        raise Exception(f'Archiver \'{name}\' is not available on this system')
+
+    # 0 always stores a file type, whatever the archiver calls its lowest level
+    levels = {archiver.level, *(level for level in type_levels.values() if not level == 0)}
+    invalid_levels = sorted(level for level in levels if not level in archiver.levels)
+    if invalid_levels:
+        raise Exception(f'Archiver \'{name}\' only takes levels {archiver.levels.start} to {archiver.levels.stop - 1}, not {", ".join(map(str, invalid_levels))}')
+
+    return archiver
+
+
+def patch_notes(files_json):
+    notes = '\n====== Patch ======\nExtract over v{} of {} to update it.\n'.format(files_json['base']['date_string'], files_json['Title'])
+    if files_json['patch']['deleted']:
+        notes += 'Then delete these files from {}/zone:\n{}\n'.format(files_json['FolderName'], '\n'.join(files_json['patch']['deleted']))
+
+    return notes
+
+
+def start_archive(files_json, norm_workshopname, archiver):
+    comment_contents = RAR_COMMENT_CONTENTS
+    if files_json.get('patch'):
+        comment_contents += patch_notes(files_json)
+        # only the changed files were staged, the archivers plan their compression from this manifest
+        files_json = {**files_json, 'manifest': files_json['patch']['manifest']}
+
+    # every item has its own readme next to its staged files, the patch notes of one item can't end up in another archive
+    with open(GAME_CONTENT_PATH.joinpath(norm_workshopname, RAR_COMMENT_FILENAME), 'w') as fhandle:
+        fhandle.write(comment_contents)
+
+    # the documents uploaded for the previous archives must not be forwarded in place of the new volumes
+    JOB_STORE.update(files_json['PublisherID'], data={'documents': {}})
+    JOB_STORE.restart_post_files(files_json['PublisherID'])
+
+    return archiver.start(files_json, norm_workshopname)
+
+
+def find_archive_volumes(workshop_id, norm_workshopname, archiver):
+    archive_volumes = []
+    for dir_object in get_archive_dir(workshop_id).iterdir():
+        if dir_object.is_file() and archiver.is_volume(dir_object, norm_workshopname):
+            archive_volumes.append(dir_object)
+
+    return sorted(archive_volumes, key=archiver.volume_number)
+
+
+def wait_archive(archive_process, workshop_id):
+    returncode = archive_process.wait()
+    if returncode:
+        raise Exception(f'Archiving {workshop_id} failed with exit code {returncode}')
+
+
+def iter_finished_volumes(archive_process, workshop_id, norm_workshopname, archiver):
+    yielded_volumes = set()
+    while True:
+        archive_finished = archive_process.poll() is not None
+        if archive_finished:
+            # the last volumes of a failed archive are incomplete
+            wait_archive(archive_process, workshop_id)
+
+        archive_volumes = find_archive_volumes(workshop_id, norm_workshopname, archiver)
+        if not archive_finished:
+            # the streamable archivers only start the next volume after closing the previous one, and never reopen it
+            archive_volumes = archive_volumes[:-1]
+
+        for archive_volume in archive_volumes:
+            if not archive_volume.name in yielded_volumes:
+                yielded_volumes.add(archive_volume.name)
+                yield archive_volume
+
+        if archive_finished:
+            break
+
+        sleep(RAR_VOLUME_POLL_INTERVAL)
+
+
+def collect_archive_files(files_json, norm_workshopname, archiver):
+    archive_volumes = find_archive_volumes(files_json['PublisherID'], norm_workshopname, archiver)
+    files_json['rar_files'] = [archive_volume.name for archive_volume in archive_volumes]
+    files_json['archive_bytes'] = sum(archive_volume.stat().st_size for archive_volume in archive_volumes)
+
+    return files_json
+
+
+def package_workshop_item(workshop_id, archiver=None, make_patch=False):
+    archiver = archiver or get_archiver()
+    (files_json, norm_workshopname) = prepare_workshop_item(workshop_id, make_patch)
+
+    with METRICS.measure('archive', item=workshop_id, archiver=archiver.name) as measurement:
+        archive_process = start_archive(files_json, norm_workshopname, archiver)
+        wait_archive(archive_process, workshop_id)
+
+        # os.rmdir(norm_workshopname)
+        collect_archive_files(files_json, norm_workshopname, archiver)
+        measurement['bytes'] = files_json['archive_bytes']
+
+    return files_json
+
+
+def download_and_package(workshop_id, archiver=None):
+    with STEAMCMD_POOL.acquire() as worker:
+        download_workshop_item(workshop_id, worker)
+
+    return package_workshop_item(workshop_id, archiver)
+
+
+def scrape_steam_data(steam_soup, changelog_soup):
+    steam_data = {}
+
+    date_string = changelog_soup.css.select_one('div.detailBox > div.changelog').string.strip()[8:-2].split(' @ ')[0]
+    if date_string:
+        date_string = f'{int(date_string[:2].strip()):02} ' + date_string[2:]
+        if not ',' in date_string:
+            date_string = f'{date_string}, {datetime.now().year}'
+
+        date_string = datetime.strptime(date_string, '%d %b, %Y').strftime('%Y.%m.%d')
+    else:
+        date_string = datetime.now().strftime('%Y.%m.%d')
+    steam_data['date_string'] = date_string
+
+    # the changelog entry id is the update unix timestamp
+    changelog_entry = changelog_soup.css.select_one('div.changeLogCtn > p[id]')
+    if changelog_entry and changelog_entry['id'].isdigit():
+        steam_data['time_updated'] = int(changelog_entry['id'])
+
+    steam_data['authors'] = scrape_authors(steam_soup)
+
+    images = {'highlights': [], 'preview': None}
+    img_preview = steam_soup.css.select_one('img#previewImageMain')
+    if not img_preview:
+        img_preview = steam_soup.css.select_one('img#previewImage')
+    images['preview'] = img_preview['src'].split('?')[0]+STEAM_PREVIEW_PARAMS
+    images['highlights'] = scrape_highlights(steam_soup)
+
+    steam_data['images'] = {**images}
+
+    title = steam_soup.css.select_one('div.workshopItemTitle')
+    if title:
+        steam_data['Title'] = title.string.strip()
+    
+    return steam_data
+
+
+def scrape_authors(steam_soup):
+    authors = []
+    for friend_block in steam_soup.css.select_one('div.creatorsBlock').contents:
+        if isinstance(friend_block, Tag):
+            friend_block = friend_block.select_one('div.friendBlockContent')
+            authors.append(friend_block.contents[0].strip())
+
+    return ', '.join(authors)
+
+
+def scrape_highlights(steam_soup):
+    highlights = []
+    highlight_area = steam_soup.css.select_one('div#highlight_player_area')
+    if highlight_area:
+        if len(highlight_area.contents) > 1:
+            for child in highlight_area.children:
+                if isinstance(child, Tag) and 'class' in child.attrs and 'highlight_screenshot' in child['class']:
+                    # highlight_url = child.select_one('a[data-panel]')['href'].split("javascript:ShowEnlargedImagePreview( '")[1].split("' );")[0].split('?')[0]+'?imw=637&imh=358&impolicy=Letterbox&ima=fit'
+                    highlight_url = child.select_one('a[data-panel]')['onclick'].split("ShowEnlargedImagePreview( '")[1].split("' );")[0].split('?')[0]+STEAM_HIGHLIGHT_PARAMS
+                    highlights.append(highlight_url)
+        else:
+            highlights.append(highlight_area.select_one('img')['src'])
+
+    return highlights
+
+
+def fetch_published_file_details(workshop_ids):
+    file_details = {}
+    for i in range(0, len(workshop_ids), STEAM_API_BATCH_SIZE):
+        ids_slice = workshop_ids[i:i + STEAM_API_BATCH_SIZE]
+        form_data = {'itemcount': len(ids_slice)}
+        for j, workshop_id in enumerate(ids_slice):
+            form_data[f'publishedfileids[{j}]'] = workshop_id
+
+        api_response = http_post(f'{STEAM_API_URL}ISteamRemoteStorage/GetPublishedFileDetails/v1/', form_data)
+        for details in api_response['response'].get('publishedfiledetails', []):
+            if details.get('result') == 1 and details.get('consumer_app_id') == 311210:
+                file_details[details['publishedfileid']] = details
+
+    return file_details
+
+
+def fetch_api_highlights(workshop_ids):
+    highlights = {}
+    for i in range(0, len(workshop_ids), STEAM_API_BATCH_SIZE):
+        ids_slice = workshop_ids[i:i + STEAM_API_BATCH_SIZE]
+        params = {'key': STEAM_API_KEY, 'includeadditionalpreviews': 'true'}
+        for j, workshop_id in enumerate(ids_slice):
+            params[f'publishedfileids[{j}]'] = workshop_id
+
+        api_response = json.loads(http_get(f'{STEAM_API_URL}IPublishedFileService/GetDetails/v1/', params=params))
+        for details in api_response['response'].get('publishedfiledetails', []):
+            # preview_type 0 are images, the others are youtube/sketchfab links
+            highlights[details['publishedfileid']] = [
+                preview['url'].split('?')[0]+STEAM_HIGHLIGHT_PARAMS
+                for preview in sorted(details.get('previews', []), key=lambda preview: preview.get('sortorder', 0))
+                if preview.get('preview_type') == 0 and preview.get('url')
+            ]
+
+    return highlights
+
+
+def fetch_creator_names(steam_ids):
+    creator_names = {}
+    if STEAM_API_KEY:
+        for i in range(0, len(steam_ids), STEAM_API_BATCH_SIZE):
+            api_response = json.loads(http_get(
+                f'{STEAM_API_URL}ISteamUser/GetPlayerSummaries/v2/',
+                params={'key': STEAM_API_KEY, 'steamids': ','.join(steam_ids[i:i + STEAM_API_BATCH_SIZE])},
+                ttl=HTTP_IMAGE_CACHE_TTL
+            ))
+            for player in api_response['response'].get('players', []):
+                creator_names[player['steamid']] = player['personaname']
+    else:
+        for steam_id in steam_ids:
+            profile_xml = http_get(f'https://steamcommunity.com/profiles/{steam_id}/', params={'xml': 1}, ttl=HTTP_IMAGE_CACHE_TTL)
+            name_match = STEAM_PROFILE_NAME_REGEX.search(profile_xml.decode(errors='ignore'))
+            if name_match:
+                creator_names[steam_id] = name_match.group(1).strip()
+
+    return creator_names
+
+
+def fetch_steam_data_batch(workshop_ids):
+    file_details = fetch_published_file_details(workshop_ids)
+    creator_names = fetch_creator_names(list({details['creator'] for details in file_details.values()}))
+    highlights = fetch_api_highlights(list(file_details)) if STEAM_API_KEY else {}
+
+    steam_data_batch = {}
+    for workshop_id, details in file_details.items():
+        steam_data_batch[workshop_id] = {
+            'date_string': datetime.fromtimestamp(details['time_updated']).strftime('%Y.%m.%d'),
+            'time_updated': details['time_updated'],
+            'file_size': int(details.get('file_size') or 0) or None,
+            'authors': creator_names.get(details['creator'], ''),
+            # highlights stay None when they can only be scraped from the item page
+            'images': {'highlights': highlights.get(workshop_id), 'preview': details['preview_url'].split('?')[0]+STEAM_PREVIEW_PARAMS},
+            'Title': details['title'].strip(),
+        }
+
+    return steam_data_batch
+
+
+def complete_steam_data(workshop_id, steam_data, steam_soup=None):
+    if steam_data['images']['highlights'] is None:
+        steam_soup = steam_soup or fetch_steam_page(workshop_id)
+        if not steam_soup:
+            raise Exception(f'Invalid SteamID {workshop_id}')
+
+        steam_data['images']['highlights'] = scrape_highlights(steam_soup)
+
+    if steam_soup:
+        # the api only names the creator, a page fetched anyway lists every contributor
+        steam_data['authors'] = scrape_authors(steam_soup)
+
+    return steam_data
+
+
+def prefetch_steam_data(workshop_ids, metadata_provider=METADATA_PROVIDER):
+    if not metadata_provider == 'api':
+        return {}
+
+    try:
+        return fetch_steam_data_batch(workshop_ids)
+    except Exception as e:
+        print(f'Steam API request failed ({e}). Falling back to the item pages')
+        return {}
+
+
+class ProgressReporter:
+    def __init__(self, interval):
+        self.interval = interval
+        self.transfers = {}
+        self.lines = {}
+        self.lock = threading.Lock()
+
+    def transfer(self, label, current, total, action='Uploading', finished_action='Uploaded'):
+        now = perf_counter()
+        finished = current >= total
+        with self.lock:
+            transfer = self.transfers.setdefault(label, {'started': now, 'start_bytes': current, 'printed': 0.0})
+            if not finished and now - transfer['printed'] < self.interval:
+                return
+
+            transfer['printed'] = now
+            if finished:
+                self.transfers.pop(label)
+
+        # the speed only counts bytes of this run, a resumed upload starts above zero
+        elapsed = now - transfer['started']
+        speed = (current - transfer['start_bytes']) / elapsed if elapsed else 0.0
+        eta = (total - current) / speed if speed else 0.0
+        print(f'[{action}...] "{label}" - {current / total * 100:0.2f}% {format_bytes(speed)}/s ETA {format_duration(eta)}')
+
+        if finished:
+            print(f'[{finished_action}] "{label}"\n')
+
+    def line(self, label, text, force=False):
+        now = perf_counter()
+        with self.lock:
+            last_line = self.lines.setdefault(label, {'printed': 0.0, 'pending': None})
+            if not force and now - last_line['printed'] < self.interval:
+                last_line['pending'] = text
+                return
+
+            last_line['printed'] = now
+            last_line['pending'] = None
+
+        print(text)
+
+    def flush(self, label):
+        with self.lock:
+            last_line = self.lines.pop(label, None)
+
+        if last_line and last_line['pending']:
+            print(last_line['pending'])
+
+
+class Metrics:
+    def __init__(self, log_path, prometheus_path):
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        self.stages = {}
+        self.written_at = 0.0
+        self.lock = threading.Lock()
+
+    def stage_counters(self, stage):
+        return self.stages.setdefault(stage, {'runs': 0, 'failures': 0, 'seconds': 0.0, 'bytes': 0, 'retries': 0})
+
+    def log(self, event):
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.log_path, 'a') as fhandle:
+            fhandle.write(json.dumps({'time': round(time(), 3), **event}) + '\n')
+
+    def record(self, stage, seconds, bytes_moved=0, failed=False, **fields):
+        with self.lock:
+            counters = self.stage_counters(stage)
+            counters['runs'] += 1
+            counters['failures'] += int(failed)
+            counters['seconds'] += seconds
+            counters['bytes'] += bytes_moved
+            self.log({'event': 'stage', 'stage': stage, 'seconds': round(seconds, 3), 'bytes': bytes_moved, 'ok': not failed, **fields})
+            should_write = time() - self.written_at >= METRICS_WRITE_INTERVAL
+
+        if should_write:
+            self.write_prometheus()
+
+    def add_retries(self, stage, retries=1, **fields):
+        with self.lock:
+            self.stage_counters(stage)['retries'] += retries
+            self.log({'event': 'retry', 'stage': stage, 'retries': retries, **fields})
+
+    @contextmanager
+    def measure(self, stage, **fields):
+        # the caller fills in the bytes it moved
+        measurement = {'bytes': 0}
+        start = perf_counter()
+        try:
+            yield measurement
+        except Exception:
+            self.record(stage, perf_counter() - start, measurement['bytes'], True, **fields)
+            raise
+
+        self.record(stage, perf_counter() - start, measurement['bytes'], **fields)
+
+    def write_prometheus(self):
+        metric_lines = []
+        with self.lock:
+            self.written_at = time()
+            for metric_name, metric_help, counter_name in METRICS_PROMETHEUS_COUNTERS:
+                metric_lines.append(f'# HELP {metric_name} {metric_help}')
+                metric_lines.append(f'# TYPE {metric_name} counter')
+                for stage, counters in sorted(self.stages.items()):
+                    metric_lines.append(f'{metric_name}{{stage="{stage}"}} {round(counters[counter_name], 3)}')
+
+        self.prometheus_path.parent.mkdir(parents=True, exist_ok=True)
+        prometheus_tmp_path = self.prometheus_path.with_suffix(f'.{threading.get_ident()}.tmp')
+        with open(prometheus_tmp_path, 'w') as fhandle:
+            fhandle.write('\n'.join(metric_lines) + '\n')
+        os.replace(prometheus_tmp_path, self.prometheus_path)
+
+
+PROGRESS = ProgressReporter(PROGRESS_INTERVAL)
+METRICS = Metrics(CACHE_DIR.joinpath('metrics.jsonl'), CACHE_DIR.joinpath('metrics.prom'))
+
+
+def print_upload_progress(current, total, *args):
+    PROGRESS.transfer(args[0], current, total)
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = perf_counter()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait_time > 0:
+            sleep(wait_time)
+
+
+class ImageCache:
+    def __init__(self, cache_dir, memory_limit, disk_limit):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+
+    def image_path(self, url):
+        return self.cache_dir.joinpath(hashlib.sha1(url.encode()).hexdigest())
+
+    def put_memory(self, url, image):
+        with self.lock:
+            if url in self.memory:
+                self.memory_bytes -= len(self.memory.pop(url))
+
+            self.memory[url] = image
+            self.memory_bytes += len(image)
+            while self.memory_bytes > self.memory_limit and len(self.memory) > 1:
+                self.memory_bytes -= len(self.memory.popitem(last=False)[1])
+
+    def get(self, url):
+        with self.lock:
+            if url in self.memory:
+                self.memory.move_to_end(url)
+                return self.memory[url]
+
+        image_path = self.image_path(url)
+        try:
+            image = image_path.read_bytes()
+            # the mtime is the last use for the disk eviction
+            os.utime(image_path)
+        except OSError:
+            return None
+
+        self.put_memory(url, image)
+        return image
+
+    def put(self, url, image):
+        self.put_memory(url, image)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        image_path = self.image_path(url)
+        image_tmp_path = image_path.with_suffix(f'.{threading.get_ident()}.tmp')
+        image_tmp_path.write_bytes(image)
+        os.replace(image_tmp_path, image_path)
+
+        self.evict_disk()
+
+    def evict_disk(self):
+        cached_images = []
+        for image_path in self.cache_dir.iterdir():
+            try:
+                cached_images.append((image_path.stat(), image_path))
+            except OSError:
+                continue
+
+        disk_bytes = sum(image_stat.st_size for image_stat, _ in cached_images)
+        for image_stat, image_path in sorted(cached_images, key=lambda cached_image: cached_image[0].st_mtime):
+            if disk_bytes <= self.disk_limit:
+                break
+
+            image_path.unlink(missing_ok=True)
+            disk_bytes -= image_stat.st_size
+
+
+IMAGE_CACHE = ImageCache(CACHE_DIR.joinpath('imagecache'), IMAGE_MEMORY_CACHE_SIZE, IMAGE_DISK_CACHE_SIZE)
+IMAGE_RATE_LIMITER = RateLimiter(IMAGE_FETCH_RATE)
+
+
+def fetch_image(url):
+    image = IMAGE_CACHE.get(url)
+    if image is None:
+        IMAGE_RATE_LIMITER.wait()
+        with METRICS.measure('image_fetch') as measurement:
+            response = HTTP_SESSION.get(url, timeout=HTTP_TIMEOUT)
+            response.raise_for_status()
+            image = response.content
+            measurement['bytes'] = len(image)
+        IMAGE_CACHE.put(url, image)
+
+    return image
+
+
+def fetch_images(imgURLs):
+    with ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS) as executor:
+        return list(executor.map(fetch_image, imgURLs))
+
+
+def download_images(imgURLs):
+    media = []
+    for image in fetch_images(imgURLs):
+        image_content = BytesIO(image)
+        image_content.name = 'image.jpeg'
+        media.append(InputMediaPhoto(image_content))
+
+    return media
+
+
+class SessionPool:
+    def __init__(self, session_names=()):
+        self.session_names = list(session_names)
+        self.clients = None
+        self.primary_client = None
+        self.loads = {}
+        self.waits = {}
+        self.condition = threading.Condition()
+
+    def start(self):
+        self.clients = []
+        for session_name in self.session_names:
+            self.clients.append(ensure_telegram_connection(session_name))
+            print(f'Uploading through the extra session \'{session_name}\'')
+
+    def set_primary(self, primary_client):
+        if self.clients is None:
+            self.start()
+
+        if not primary_client is self.primary_client:
+            # documents uploaded by another account could not be sent by the primary one
+            account_id = TELEGRAM_LOOP.call(primary_client.get_me).id
+            for session_name, session_client in zip(self.session_names, self.clients):
+                if not TELEGRAM_LOOP.call(session_client.get_me).id == account_id:
+                    raise Exception(f'Session \'{session_name}\' is not logged in the same account as \'{SESSION_NAME}\'')
+            self.primary_client = primary_client
+
+    def acquire(self, primary_client):
+        with self.condition:
+            self.set_primary(primary_client)
+            while True:
+                now = time()
+                ready_clients = [client for client in [primary_client] + self.clients if self.waits.get(client, 0) <= now]
+                if ready_clients:
+                    break
+
+                self.condition.wait(min(self.waits.values()) - now)
+
+            upload_client = min(ready_clients, key=lambda client: self.loads.get(client, 0))
+            self.loads[upload_client] = self.loads.get(upload_client, 0) + 1
+
+        return upload_client
+
+    def release(self, upload_client):
+        with self.condition:
+            self.loads[upload_client] -= 1
+            self.condition.notify_all()
+
+    def flood_wait(self, upload_client, seconds):
+        with self.condition:
+            self.waits[upload_client] = time() + seconds
+            self.condition.notify_all()
+
+    def stop(self):
+        for session_client in self.clients or []:
+            TELEGRAM_LOOP.call(session_client.stop)
+        self.clients = None
+        self.primary_client = None
+
+
+UPLOAD_POOL = SessionPool()
+
+
+def upload_checkpoint_path(file_path):
+    file_stat = file_path.stat()
+    checkpoint_key = f'{file_path.resolve()}:{file_stat.st_size}:{file_stat.st_mtime_ns}'
+
+    return UPLOAD_CHECKPOINT_DIR.joinpath(hashlib.sha1(checkpoint_key.encode()).hexdigest() + '.json')
+
+
+class UploadCheckpoint:
+    def __init__(self, file_path, total_parts, new_file_id):
+        self.path = upload_checkpoint_path(file_path)
+        self.total_parts = total_parts
+        self.lock = threading.Lock()
+        self.saved_at = 0
+
+        checkpoint = self.load()
+        # telegram only keeps unfinished uploads for a while, older parts would be reported missing
+        if checkpoint and checkpoint['total_parts'] == total_parts and time() - checkpoint['created'] < UPLOAD_CHECKPOINT_TTL:
+            self.file_id = checkpoint['file_id']
+            self.created = checkpoint['created']
+            self.parts = set(checkpoint['parts'])
+        else:
+            self.file_id = new_file_id()
+            self.created = time()
+            self.parts = set()
+
+    def load(self):
         try:
-            chat = tg_client.get_chat(user_input)
-        except ValueError:
-            print('You have not joined this chat. Try again')
-            continue
-        except PeerIdInvalid:
-            print('Inexistent chat id. Try again')
-            continue
-        
-        if not chat.type == ChatType.CHANNEL:
-            print('Provided id is not from a channel. Try again')
-            continue
-        elif not chat.linked_chat:
-            print('Channel doesn\'t have a linked chat for comments. Try again')
-            continue
+            with open(self.path) as fhandle:
+                return json.loads(fhandle.read())
+        except (OSError, ValueError):
+            return None
+
+    def save(self):
+        with self.lock:
+            checkpoint = {'file_id': self.file_id, 'total_parts': self.total_parts, 'created': self.created, 'parts': sorted(self.parts)}
+            self.saved_at = time()
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            checkpoint_tmp_path = self.path.with_suffix(f'.{threading.get_ident()}.tmp')
+            with open(checkpoint_tmp_path, 'w') as fhandle:
+                fhandle.write(json.dumps(checkpoint))
+            os.replace(checkpoint_tmp_path, self.path)
+
+    def add(self, file_part):
+        with self.lock:
+            self.parts.add(file_part)
+            should_save = time() - self.saved_at >= UPLOAD_CHECKPOINT_INTERVAL
+
+        if should_save:
+            self.save()
+
+
+def save_file_parts(tg_client: Client, file_path, part_workers=UPLOAD_PART_WORKERS, progress=None, progress_args=()):
+    file_size = file_path.stat().st_size
+    if file_size <= UPLOAD_BIG_FILE_SIZE:
+        return TELEGRAM_LOOP.call(tg_client.save_file, file_path, progress=progress, progress_args=progress_args)
+
+    total_parts = ceil(file_size / UPLOAD_PART_SIZE)
+    checkpoint = UploadCheckpoint(file_path, total_parts, tg_client.rnd_id)
+    if checkpoint.parts:
+        print(f'[Resuming] "{file_path.name}" - {len(checkpoint.parts)}/{total_parts} parts already uploaded')
+
+    uploaded_parts = len(checkpoint.parts)
+    progress_lock = threading.Lock()
+
+    def upload_part(file_part):
+        nonlocal uploaded_parts
+        with open(file_path, 'rb') as fhandle:
+            fhandle.seek(file_part * UPLOAD_PART_SIZE)
+            chunk = fhandle.read(UPLOAD_PART_SIZE)
+
+        TELEGRAM_LOOP.call(
+            tg_client.invoke,
+            SaveBigFilePart(file_id=checkpoint.file_id, file_part=file_part, file_total_parts=total_parts, bytes=chunk)
+        )
+        checkpoint.add(file_part)
 
-        print(f'Will upload to \'{chat.title}\' and \'{chat.linked_chat.title}\'')
-        return user_input
+        if progress:
+            with progress_lock:
+                uploaded_parts += 1
+                progress(min(uploaded_parts * UPLOAD_PART_SIZE, file_size), file_size, *progress_args)
 
+    missing_parts = [file_part for file_part in range(total_parts) if not file_part in checkpoint.parts]
+    for attempt in range(UPLOAD_PART_RETRIES + 1):
+        with ThreadPoolExecutor(max_workers=max(1, part_workers)) as executor:
+            part_futures = [executor.submit(upload_part, file_part) for file_part in missing_parts]
+        checkpoint.save()
 
-def cache_content(content_json):
-    map_cachedir = CACHE_DIR.joinpath(content_json['PublisherID'])
-    map_cachedir.mkdir(exist_ok=True)
-    if map_cachedir.exists():
-        for map_cachedir_object in map_cachedir.iterdir():
-            if map_cachedir_object.is_file() or map_cachedir_object.is_symlink():
-                map_cachedir_object.unlink()
-            elif map_cachedir_object.is_dir():
-                shutil.rmtree(map_cachedir_object, ignore_errors=True)
+        missing_parts = [file_part for file_part in missing_parts if not file_part in checkpoint.parts]
+        if not missing_parts:
+            break
 
-    for rar_part in content_json['rar_files']:
-        shutil.move(GAME_CONTENT_PATH.joinpath(rar_part), map_cachedir)
-    
-    with open(map_cachedir.joinpath(f'{content_json["PublisherID"]}.json'), 'w') as fhandle:
-        fhandle.write(json.dumps(content_json, indent=4))
-
-
-def download_and_package(workshop_id):
-    download_finished = False
-    validate = None
-    timeout_count = 0
-    fatal_error = False
-    while not download_finished:
-        if timeout_count >= 3 or fatal_error:
-            reset_steamcmd()
-
-        if validate:
-            validate = 'validate'
-
-        steam_cmd = [
-            'steamcmd.exe',
-            '+login anonymous',
-            '+workshop_download_item 311210 {}'.format(workshop_id),
-            '+quit',
-            '{}'.format(validate)
-        ]
-        steam_popen = popen(steam_cmd)
+        part_errors = [future.exception() for future in part_futures if future.exception()]
+        flood_waits = [part_error for part_error in part_errors if isinstance(part_error, FloodWait)]
+        if flood_waits:
+            # the session pool moves the volume to another session instead of waiting here
+            checkpoint.save()
+            raise flood_waits[0]
 
-        validate = None
+        if attempt == UPLOAD_PART_RETRIES:
+            raise part_errors[0]
 
-        for stdout_line in iter(steam_popen.stdout.readline, ""):
-            print(stdout_line)
+        print(f'[Retrying] "{file_path.name}" - {len(missing_parts)} parts failed ({part_errors[0]})')
+        METRICS.add_retries('upload', len(missing_parts), file=file_path.name)
+        sleep(UPLOAD_RETRY_DELAY * (attempt + 1))
 
-            if Outputs.DOWNLOAD_TIMEOUT.value in stdout_line:
-                validate = True
-                timeout_count += 1
-            elif Outputs.DOWNLOAD_FAILURE.value in stdout_line:
-                fatal_error = True
-            elif Outputs.DOWNLOAD_SUCCESS.value in stdout_line:
-                download_finished = True
+    return InputFileBig(id=checkpoint.file_id, parts=total_parts, name=file_path.name)
 
-        steam_popen.terminate()
 
-        if not steam_popen.poll() == 0:
-            raise Exception('Error in steamcmd.exe termination')
-        
-    os.chdir(GAME_CONTENT_PATH)
-    files_json = {}
-    with open(Path(workshop_id, 'workshop.json')) as fhandle:
-        files_json = json.loads(fhandle.read())
+def upload_document(tg_client: Client, inputpeer, file_path, part_workers=UPLOAD_PART_WORKERS):
+    with METRICS.measure('upload', file=file_path.name) as measurement:
+        while True:
+            # every volume goes through the least loaded session, the primary one included
+            upload_client = UPLOAD_POOL.acquire(tg_client)
+            try:
+                document = upload_document_once(upload_client, inputpeer, file_path, part_workers)
+                break
+            except FloodWait as e:
+                print(f'[FloodWait] "{file_path.name}" - session waits {e.value}s, moving the upload')
+                UPLOAD_POOL.flood_wait(upload_client, e.value)
+                METRICS.add_retries('upload', file=file_path.name, reason='flood_wait')
+            finally:
+                UPLOAD_POOL.release(upload_client)
 
-    if not files_json:
-        raise Exception('Could not load workshop.json')
+        measurement['bytes'] = file_path.stat().st_size
 
-    norm_workshopname = re.sub('[^A-Za-z0-9]+', '_', files_json['Title'])
-    files_json['content_size'] = format_bytes(sum(f.stat().st_size for f in Path('.').glob('**/*') if f.is_file()))
-    mapfiles_path = Path(norm_workshopname, files_json['FolderName'])
-    rarfile_path = Path('[T7] {} ({}).rar'.format(norm_workshopname, files_json['content_size']))
+    return document
 
 
-    supported_langs = {l: False for l in ALL_LANGS}
-    for dir_object in GAME_CONTENT_PATH.joinpath(workshop_id).iterdir():
-        for i in range(len(ALL_LANGS)):
-            if f'{ALL_LANGS[i]}_' in dir_object.name:
-                supported_langs[ALL_LANGS[i]] = True
+def upload_document_once(tg_client: Client, inputpeer, file_path, part_workers=UPLOAD_PART_WORKERS):
+    checkpoint_path = upload_checkpoint_path(file_path)
+    for attempt in range(2):
+        try:
+            media = TELEGRAM_LOOP.call(
+                tg_client.invoke,
+                UploadMedia(
+                    peer=inputpeer,
+                    media=InputMediaUploadedDocument(
+                        file=save_file_parts(tg_client, file_path, part_workers, progress=print_upload_progress, progress_args=(file_path.name,)),
+                        mime_type=mimetypes.guess_type(file_path.name)[0] or 'application/zip',
+                        attributes=[
+                            DocumentAttributeFilename(file_name=file_path.name)
+                        ]
+                    )
+                ) 
+            )
+        except (FilePartMissing, FilePartsInvalid):
+            # the parts of the checkpoint expired on telegram's side, start the file again
+            checkpoint_path.unlink(missing_ok=True)
+            if attempt:
+                raise
+            METRICS.add_retries('upload', file=file_path.name)
+            continue
 
-    files_json['supported_langs'] = supported_langs
-    print(ALL_LANGS, supported_langs, sep='\n')
+        break
 
+    checkpoint_path.unlink(missing_ok=True)
 
-    shutil.copytree(Path(workshop_id), mapfiles_path.joinpath('zone'), copy_function=shutil.move, dirs_exist_ok=True)
-    shutil.rmtree(Path(workshop_id)) #, ignore_errors=True
+    return {
+        'id': media.document.id,
+        'access_hash': media.document.access_hash,
+        'file_reference': media.document.file_reference.hex()
+    }
 
 
-    with open(RAR_COMMENT_FILENAME, 'w') as fhandle:
-        fhandle.write(RAR_COMMENT_CONTENTS)
+def document_media(tg_client: Client, document):
+    media = InputMediaDocument(
+                id=InputDocument(
+                    id=document['id'],
+                    access_hash=document['access_hash'],
+                    file_reference=bytes.fromhex(document['file_reference'])
+                )
+    )
 
-    rar_popen = popen([
-        RAR_PATH.joinpath('Rar.exe').resolve(),
-        'a',
-        '-v2000m',
-        '-z' + RAR_COMMENT_FILENAME,
-        '-df',
-        rarfile_path,
-        mapfiles_path,
-        RAR_COMMENT_FILENAME,
-        '-ep1'
-    ])
+    return InputSingleMedia(
+        media=media,
+        random_id=tg_client.rnd_id(),
+        message=''
+    )
 
-    for stdout_line in iter(rar_popen.stdout.readline, ""):
-        print(stdout_line)
 
-    # os.rmdir(norm_workshopname)
-    rar_files = []
-    for dir_object in Path('.').iterdir():
-        if '.rar' in dir_object.name and (f'[T7] {norm_workshopname}') in dir_object.name:
-            rar_files.append(dir_object.name)
-    
-    files_json['rar_files'] = rar_files
+def get_sent_message(updates):
+    return [m.message for m in filter(
+                lambda u: isinstance(u, (UpdateNewMessage, UpdateNewChannelMessage)),
+                updates.updates
+            )][0]
 
-    os.chdir(INITIAL_CWD)
-    
-    return files_json
 
+def send_documents(tg_client: Client, inputpeer, reply_to_msg_id, medias):
+    if len(medias) == 1:
+        r = TELEGRAM_LOOP.call(
+            tg_client.invoke,
+            SendMedia(peer=inputpeer, media=medias[0].media, message='', random_id=medias[0].random_id, reply_to_msg_id=reply_to_msg_id),
+            sleep_threshold=60
+        )
+    else:
+        r = TELEGRAM_LOOP.call(
+            tg_client.invoke,
+            SendMultiMedia(peer=inputpeer, multi_media=medias, reply_to_msg_id=reply_to_msg_id),
+            sleep_threshold=60
+        )
 
-def scrape_steam_data(steam_soup, changelog_soup):
-    steam_data = {}
+    return get_sent_message(r)
 
-    date_string = changelog_soup.css.select_one('div.detailBox > div.changelog').string.strip()[8:-2].split(' @ ')[0]
-    if date_string:
-        date_string = f'{int(date_string[:2].strip()):02} ' + date_string[2:]
-        if not ',' in date_string:
-            date_string = f'{date_string}, {datetime.now().year}'
 
-        date_string = datetime.strptime(date_string, '%d %b, %Y').strftime('%Y.%m.%d')
-    else:
-        date_string = datetime.now().strftime('%Y.%m.%d')
-    steam_data['date_string'] = date_string
+def document_key(file_path):
+    # a rebuilt volume keeps its name, its size and mtime tell it from the one uploaded before
+    file_stat = file_path.stat()
 
-    authors = []
-    for friend_block in steam_soup.css.select_one('div.creatorsBlock').contents:
-        if isinstance(friend_block, Tag):
-            friend_block = friend_block.select_one('div.friendBlockContent')
-            authors.append(friend_block.contents[0].strip())
+    return f'{file_path.name}:{file_stat.st_size}:{file_stat.st_mtime_ns}'
 
-    steam_data['authors'] = ', '.join(authors)
 
-    images = {'highlights': [], 'preview': None}
-    img_preview = steam_soup.css.select_one('img#previewImageMain')
-    if not img_preview:
-        img_preview = steam_soup.css.select_one('img#previewImage')
-    images['preview'] = img_preview['src'].split('?')[0]+'?imw=637&imh=358'
+def post_documents(tg_client: Client, inputpeer, reply_to_msg_id, file_paths, volume_workers=UPLOAD_VOLUME_WORKERS, part_workers=UPLOAD_PART_WORKERS, on_album_sent=None, documents=None):
+    documents = {} if documents is None else documents
+    first_msg = None
+    album = []
+    album_paths = []
 
-    highlight_area = steam_soup.css.select_one('div#highlight_player_area')
-    if highlight_area:
-        if len(highlight_area.contents) > 1:
-            for child in highlight_area.children:
-                if isinstance(child, Tag) and 'class' in child.attrs and 'highlight_screenshot' in child['class']:
-                    # highlight_url = child.select_one('a[data-panel]')['href'].split("javascript:ShowEnlargedImagePreview( '")[1].split("' );")[0].split('?')[0]+'?imw=637&imh=358&impolicy=Letterbox&ima=fit'
-                    highlight_url = child.select_one('a[data-panel]')['onclick'].split("ShowEnlargedImagePreview( '")[1].split("' );")[0].split('?')[0]+'?imw=637&imh=358&impolicy=Letterbox&ima=fit'
-                    images['highlights'].append(highlight_url)
-        else:
-            images['highlights'].append(highlight_area.select_one('img')['src'])
+    def get_document(file_path):
+        file_key = document_key(file_path)
+        if not file_key in documents:
+            documents[file_key] = upload_document(tg_client, inputpeer, file_path, part_workers)
 
-    steam_data['images'] = {**images}
+        return documents[file_key]
 
-    title = steam_soup.css.select_one('div.workshopItemTitle')
-    if title:
-        steam_data['Title'] = title.string.strip()
-    
-    return steam_data
+    def send_album():
+        album_documents = [future.result() for future in album]
+        try:
+            sent_msg = send_documents(tg_client, inputpeer, reply_to_msg_id, [document_media(tg_client, document) for document in album_documents])
+        except (FileReferenceExpired, FileReferenceInvalid, MediaEmpty):
+            # documents of an older post can no longer be sent by reference, upload them again
+            for file_path in album_paths:
+                documents.pop(document_key(file_path), None)
+            album_documents = [get_document(file_path) for file_path in album_paths]
+            sent_msg = send_documents(tg_client, inputpeer, reply_to_msg_id, [document_media(tg_client, document) for document in album_documents])
 
+        if on_album_sent:
+            on_album_sent([file_path.name for file_path in album_paths], sent_msg)
 
-def print_upload_progress(current, total, *args):
-    file_name = args[0]
-    percentage = ((current/total) * 100)
-    print(f'[Uploading...] "{file_name}" - {percentage:0.2f}%')
+        return sent_msg
 
-    if percentage == 100:
-        print(f'[Uploaded] "{file_name}"\n')
+    with ThreadPoolExecutor(max_workers=max(1, volume_workers)) as executor:
+        # file_paths may be a generator that yields volumes while Rar.exe is still writing the next ones
+        for file_path in file_paths:
+            album.append(executor.submit(get_document, file_path))
+            album_paths.append(file_path)
 
+            if len(album) == 10:
+                sent_msg = send_album()
+                first_msg = first_msg or sent_msg
+                album = []
+                album_paths = []
 
-def download_images(imgURLs):
-    media = []
-    for j in imgURLs:
-        image_content = BytesIO(requests.get(j).content)
-        image_content.name = 'image.jpeg'
-        media.append(InputMediaPhoto(image_content))
-        sleep(0.25)
+        if album:
+            sent_msg = send_album()
+            first_msg = first_msg or sent_msg
 
-    return media
+    return first_msg
 
 
-def make_telegram_post(tg_client: Client, tg_channel, upload_data):
+def make_telegram_post(tg_client: Client, tg_channels, upload_data, volume_workers=UPLOAD_VOLUME_WORKERS, part_workers=UPLOAD_PART_WORKERS, rar_paths=None, find_volumes=None):
     TEMPLATE = """**{}**
 `by {}`
 
@@ -355,8 +2570,10 @@ def make_telegram_post(tg_client: Client, tg_channel, upload_data):
 
 {}"""
     
-    if CACHE_DIR.joinpath(upload_data['PublisherID']).exists():
-        os.chdir(CACHE_DIR.joinpath(upload_data['PublisherID']))
+    workshop_id = upload_data['PublisherID']
+    map_cachedir = get_archive_dir(workshop_id)
+    if not isinstance(tg_channels, (list, tuple)):
+        tg_channels = [tg_channels]
 
     if upload_data.get('supported_langs'):
         if list(upload_data['supported_langs'].values()).count(True) == 1 and upload_data['supported_langs'].get('en'):
@@ -380,162 +2597,126 @@ def make_telegram_post(tg_client: Client, tg_channel, upload_data):
     else:
         size_str = 'Calculando Tamanho/Calculating Size'
 
-    post_msg = tg_client.send_photo(
-        tg_channel, 
-        upload_data['images']['preview'], 
-        TEMPLATE.format(
-            upload_data['Title'], 
-            upload_data['authors'], 
-            '🔄 Uploading...', 
-            size_str, 
-            upload_data['date_string'], 
-            upload_data['PublisherID'], 
-            upload_data['PublisherID'], 
-            langs_str,
-            tags_str
-        ),
-        parse_mode=ParseMode.MARKDOWN
-    )
+    if rar_paths is None and upload_data.get('streaming'):
+        raise Exception(f'The archive of {workshop_id} was interrupted while streaming it. Run it again to package and post it')
+    if rar_paths is None and upload_data.get('rar_files'):
+        rar_paths = [map_cachedir.joinpath(rar) for rar in upload_data['rar_files']]
 
-    tocomment_post = tg_client.get_discussion_message(
-        post_msg.chat.id,
-        post_msg.id,
-    )
+    job = JOB_STORE.get(workshop_id)
+    if job and not job['state'] in ('posted', 'files_uploaded'):
+        # posting a finished job again starts new posts, the posts of an interrupted run or reopened by --watch are resumed
+        JOB_STORE.clear_finished_posts(workshop_id)
 
-    MAX_IMAGES = 6
-    if len(upload_data['images']['highlights']) > MAX_IMAGES:
-        execution_times = ceil(len(upload_data['images']['highlights']) / MAX_IMAGES)
-        for i in range(execution_times):
-            if not(i == execution_times - 1):
-                images_slice = upload_data['images']['highlights'][i * MAX_IMAGES:(i*MAX_IMAGES) + MAX_IMAGES]
-            else:
-                images_slice = upload_data['images']['highlights'][i * MAX_IMAGES:]
+    # documents uploaded once, for the first channel or an earlier post, are only forwarded by reference afterwards
+    documents = dict((job or {}).get('data', {}).get('documents') or upload_data.get('documents') or {})
+    upload_data['documents'] = documents
 
-            media_group = download_images(images_slice)
+    def save_documents():
+        JOB_STORE.update(workshop_id, data={'documents': documents})
 
-            tocomment_post.reply_media_group(media_group)
+    def post_to_channel(tg_channel, rar_paths):
+        post = JOB_STORE.get_post(workshop_id, tg_channel)
+        if post and post['post_msg_id']:
+            print(f'Resuming the telegram post of {workshop_id} in {tg_channel}')
+            post_msg = TELEGRAM_LOOP.call(tg_client.get_messages, post['post_chat_id'], post['post_msg_id'])
+        else:
+            post_msg = TELEGRAM_LOOP.call(
+                tg_client.send_photo,
+                tg_channel, 
+                upload_data['images']['preview'], 
+                TEMPLATE.format(
+                    upload_data['Title'], 
+                    upload_data['authors'], 
+                    '🔄 Uploading...', 
+                    size_str, 
+                    upload_data['date_string'], 
+                    upload_data['PublisherID'], 
+                    upload_data['PublisherID'], 
+                    langs_str,
+                    tags_str
+                ),
+                parse_mode=ParseMode.MARKDOWN
+            )
+            JOB_STORE.update(workshop_id, 'posted', upload_data)
+            JOB_STORE.update_post(workshop_id, tg_channel, 'posted', post_chat_id=post_msg.chat.id, post_msg_id=post_msg.id)
+            post = JOB_STORE.get_post(workshop_id, tg_channel)
 
-    elif len(upload_data['images']['highlights']) > 1:
-        media_group = download_images(upload_data['images']['highlights'])
+        if post['state'] == 'done':
+            return (post_msg, post['files_msg_id'])
 
-        tocomment_post.reply_media_group(media_group)
+        tocomment_post = TELEGRAM_LOOP.call(
+            tg_client.get_discussion_message,
+            post_msg.chat.id,
+            post_msg.id,
+        )
+        JOB_STORE.update_post(workshop_id, tg_channel, comment_msg_id=tocomment_post.id)
 
-    elif len(upload_data['images']['highlights']) == 1:
-        tocomment_post.reply_photo(upload_data['images']['highlights'][0])
+        MAX_IMAGES = 6
+        if post['images_sent']:
+            pass
+        elif len(upload_data['images']['highlights']) > MAX_IMAGES:
+            # fetch every highlight at once, the album batches below are then served from the image cache
+            fetch_images(upload_data['images']['highlights'])
 
-    inputpeer = tg_client.resolve_peer(tocomment_post.chat.id)
-    if upload_data.get('rar_files'):
-        if len(upload_data['rar_files']) > 10:
-            execution_times = ceil(len(upload_data['rar_files']) / 10)
+            execution_times = ceil(len(upload_data['images']['highlights']) / MAX_IMAGES)
             for i in range(execution_times):
                 if not(i == execution_times - 1):
-                    rar_slice = upload_data['rar_files'][i * 10:(i*10) + 10]
+                    images_slice = upload_data['images']['highlights'][i * MAX_IMAGES:(i*MAX_IMAGES) + MAX_IMAGES]
                 else:
-                    rar_slice = upload_data['rar_files'][i * 10:]
-
-                medias = []
-                for rar in rar_slice:
-                    media = tg_client.invoke(
-                        UploadMedia(
-                            peer=inputpeer,
-                            media=InputMediaUploadedDocument(
-                                file=tg_client.save_file(Path(rar).resolve(), progress=print_upload_progress, progress_args=(rar,)),
-                                mime_type=mimetypes.guess_type(rar)[0] or 'application/zip',
-                                attributes=[
-                                    DocumentAttributeFilename(file_name=rar)
-                                ]
-                            )
-                        ) 
-                    )
+                    images_slice = upload_data['images']['highlights'][i * MAX_IMAGES:]
 
-                    media = InputMediaDocument(
-                                id=InputDocument(
-                                    id=media.document.id,
-                                    access_hash=media.document.access_hash,
-                                    file_reference=media.document.file_reference
-                                )
-                    )
-                    
-                    medias.append(
-                        InputSingleMedia(
-                            media=media,
-                            random_id=tg_client.rnd_id(),
-                            message=''
-                        )
-                    )
+                media_group = download_images(images_slice)
 
-                if i == 0:
-                    r = tg_client.invoke(
-                        SendMultiMedia(peer=inputpeer, multi_media=medias, reply_to_msg_id=tocomment_post.id),
-                        sleep_threshold=60
-                    )
+                TELEGRAM_LOOP.call(tocomment_post.reply_media_group, media_group)
 
-                    rar_msg = [m.message for m in filter(
-                                lambda u: isinstance(u, (UpdateNewMessage, UpdateNewChannelMessage)),
-                                r.updates
-                            )][0]
-                else:
-                    tg_client.invoke(
-                        SendMultiMedia(peer=inputpeer, multi_media=medias, reply_to_msg_id=tocomment_post.id),
-                        sleep_threshold=60
-                    )
+        elif len(upload_data['images']['highlights']) > 1:
+            media_group = download_images(upload_data['images']['highlights'])
 
-        elif len(upload_data['rar_files']) > 1:
-            medias = []
-            for rar in upload_data['rar_files']:
-                media = tg_client.invoke(
-                    UploadMedia(
-                        peer=inputpeer,
-                        media=InputMediaUploadedDocument(
-                            file=tg_client.save_file(Path(rar).resolve(), progress=print_upload_progress, progress_args=(rar,)),
-                            mime_type=mimetypes.guess_type(rar)[0] or 'application/zip',
-                            attributes=[
-                                DocumentAttributeFilename(file_name=rar)
-                            ]
-                        )
-                    ) 
-                )
+            TELEGRAM_LOOP.call(tocomment_post.reply_media_group, media_group)
 
-                media = InputMediaDocument(
-                            id=InputDocument(
-                                id=media.document.id,
-                                access_hash=media.document.access_hash,
-                                file_reference=media.document.file_reference
-                            )
-                )
-                
-                medias.append(
-                    InputSingleMedia(
-                        media=media,
-                        random_id=tg_client.rnd_id(),
-                        message=''
-                    )
-                )
+        elif len(upload_data['images']['highlights']) == 1:
+            TELEGRAM_LOOP.call(tocomment_post.reply_photo, upload_data['images']['highlights'][0])
+        JOB_STORE.update_post(workshop_id, tg_channel, images_sent=1)
 
-            r = tg_client.invoke(
-                SendMultiMedia(peer=inputpeer, multi_media=medias, reply_to_msg_id=tocomment_post.id),
-                sleep_threshold=60
-            )
+        if rar_paths is None:
+            JOB_STORE.update_post(workshop_id, tg_channel, 'done')
+            return (post_msg, None)
 
-            rar_msg = [m.message for m in filter(
-                        lambda u: isinstance(u, (UpdateNewMessage, UpdateNewChannelMessage)),
-                        r.updates
-                    )][0]
-                
-            
-        elif len(upload_data['rar_files']) == 1:
-            rar_msg = tocomment_post.reply_document(
-                    Path(upload_data['rar_files'][0]).resolve(),
-                    progress=print_upload_progress,
-                    progress_args=(upload_data['rar_files'][0],)
+        inputpeer = TELEGRAM_LOOP.call(tg_client.resolve_peer, tocomment_post.chat.id)
+        if not post['state'] == 'files_uploaded':
+            def on_album_sent(file_names, sent_msg):
+                save_documents()
+                JOB_STORE.add_sent_files(workshop_id, tg_channel, file_names, sent_msg.id)
+
+            # volumes of albums sent before a restart are skipped, the rest is uploaded or forwarded
+            sent_files = set(post['sent_files'])
+            post_documents(
+                tg_client, inputpeer, tocomment_post.id,
+                (rar_path for rar_path in rar_paths if not rar_path.name in sent_files),
+                volume_workers, part_workers,
+                on_album_sent=on_album_sent,
+                documents=documents
             )
+            JOB_STORE.update_post(workshop_id, tg_channel, 'files_uploaded')
+
+        files_msg_id = JOB_STORE.get_post(workshop_id, tg_channel)['files_msg_id']
+        if not files_msg_id:
+            raise Exception('No files to upload')
 
+        files_link = f'{post_msg.link}?single&comment={files_msg_id}'
+        base_link = (upload_data.get('base') or {}).get('telegram_links', {}).get(str(tg_channel))
+        if upload_data.get('patch') and base_link:
+            # the full archive of the base version stays linked, the patch brings it to this version
+            download_str = f'[📥 Telegram]({base_link}) + [🩹 Patch]({files_link})'
+        else:
+            download_str = f'[📥 Telegram]({files_link})'
 
-        post_msg.edit_caption(
+        TELEGRAM_LOOP.call(
+            post_msg.edit_caption,
             TEMPLATE.format(
                 upload_data['Title'],
                 upload_data['authors'],
-                f'[📥 Telegram]({post_msg.link}?single&comment={rar_msg.id})',
+                download_str,
                 size_str, 
                 upload_data['date_string'],
                 upload_data['PublisherID'], 
@@ -545,67 +2726,425 @@ def make_telegram_post(tg_client: Client, tg_channel, upload_data):
             ),
             parse_mode=ParseMode.MARKDOWN
         )
+        JOB_STORE.update_post(workshop_id, tg_channel, 'done')
+
+        return (post_msg, files_msg_id)
+
+    upload_data['telegram_links'] = {}
+    for tg_channel in tg_channels:
+        with METRICS.measure('post', item=workshop_id, channel=tg_channel):
+            (post_msg, files_msg_id) = post_to_channel(tg_channel, rar_paths)
+        upload_data['telegram_links'][str(tg_channel)] = f'{post_msg.link}?single&comment={files_msg_id}' if files_msg_id else post_msg.link
+
+        if rar_paths is not None:
+            JOB_STORE.update(workshop_id, 'files_uploaded')
+            if not isinstance(rar_paths, list):
+                # a stream of volumes can only be read once, it is drained so the archiver finishes and the next channels use the cached archives
+                list(rar_paths)
+                rar_paths = find_volumes()
+
+    JOB_STORE.update(workshop_id, 'done', {'telegram_links': upload_data['telegram_links']})
+
+    return upload_data['telegram_links'][str(tg_channels[0])]
+
+
+def fetch_collection_children(collection_ids):
+    collection_children = {}
+    for i in range(0, len(collection_ids), STEAM_API_BATCH_SIZE):
+        ids_slice = collection_ids[i:i + STEAM_API_BATCH_SIZE]
+        form_data = {'collectioncount': len(ids_slice)}
+        for j, collection_id in enumerate(ids_slice):
+            form_data[f'publishedfileids[{j}]'] = collection_id
+
+        api_response = http_post(f'{STEAM_API_URL}ISteamRemoteStorage/GetCollectionDetails/v1/', form_data)
+        for details in api_response['response'].get('collectiondetails', []):
+            if details.get('result') == 1 and details.get('children'):
+                children = sorted(details['children'], key=lambda child: child.get('sortorder', 0))
+                collection_children[details['publishedfileid']] = [child['publishedfileid'] for child in children]
+
+    return collection_children
+
+
+def expand_collections(workshop_ids):
+    try:
+        collection_children = fetch_collection_children(workshop_ids)
+    except Exception as e:
+        print(f'Could not check for Steam collections ({e}). Treating every id as an item')
+        return (workshop_ids, {})
+
+    collections = {}
+    expanded_ids = []
+    for workshop_id in workshop_ids:
+        if not workshop_id in collection_children:
+            if not workshop_id in expanded_ids:
+                expanded_ids.append(workshop_id)
+            continue
+
+        # collections can hold other collections
+        members = []
+        seen = {workshop_id}
+        pending = collection_children[workshop_id]
+        while pending:
+            pending = [member_id for member_id in dict.fromkeys(pending) if not member_id in seen]
+            nested_children = fetch_collection_children(pending) if pending else {}
+
+            next_pending = []
+            for member_id in pending:
+                seen.add(member_id)
+                if member_id in nested_children:
+                    next_pending.extend(nested_children[member_id])
+                else:
+                    members.append(member_id)
+            pending = next_pending
+
+        collections[workshop_id] = members
+        print(f'Collection {workshop_id} has {len(members)} item(s)')
+        for member_id in members:
+            if not member_id in expanded_ids:
+                expanded_ids.append(member_id)
+
+    return (expanded_ids, collections)
+
+
+def post_collection_summaries(tg_client: Client, tg_channels, collections, results):
+    collection_details = fetch_published_file_details(list(collections))
+    for tg_channel in tg_channels:
+        post_collection_summary(tg_client, tg_channel, collections, results, collection_details)
+
+
+def post_collection_summary(tg_client: Client, tg_channel, collections, results, collection_details):
+    # every channel links to the item posts made in that same channel
+    telegram_links = {
+        job['PublisherID']: (job['Title'], job.get('telegram_links', {}).get(str(tg_channel), job['telegram_link']))
+        for job in results if job.get('telegram_link')
+    }
+
+    for collection_id, members in collections.items():
+        posted_members = [telegram_links[member_id] for member_id in members if member_id in telegram_links]
+        if not posted_members:
+            continue
+
+        title = collection_details.get(collection_id, {}).get('title', f'Collection {collection_id}')
+        summary_lines = [
+            f'**{title}**',
+            f'[🔗 Steam]({STEAM_URL}?id={collection_id})',
+            '',
+        ]
+        summary_lines += [f'{i}. [{member_title}]({link})' for i, (member_title, link) in enumerate(posted_members, start=1)]
+
+        summary_msg = ''
+        for summary_line in summary_lines:
+            if len(summary_msg) + len(summary_line) + 1 > TELEGRAM_MESSAGE_LIMIT:
+                TELEGRAM_LOOP.call(tg_client.send_message, tg_channel, summary_msg, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+                summary_msg = ''
+            summary_msg += summary_line + '\n'
+
+        TELEGRAM_LOOP.call(tg_client.send_message, tg_channel, summary_msg, parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True)
+
+
+class PipelineStage:
+    def __init__(self, name, action, workers=1, measure=None, batch_size=None):
+        self.name = name
+        self.action = action
+        self.workers = max(1, workers)
+        self.measure = measure
+        self.batched = batch_size is not None
+        self.batch_size = max(1, batch_size or 1)
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def run(self, jobs, on_event=None):
+        start = perf_counter()
+        with self.lock:
+            if self.started is None:
+                self.started = start
+
+        if on_event:
+            for job in jobs:
+                on_event(job, self.name, 'started')
+
+        error = None
+        try:
+            if self.batched:
+                finished = self.action(jobs)
+            else:
+                finished = [self.action(jobs[0])]
+        except Exception as e:
+            print(f'[{self.name}] {", ".join(job["PublisherID"] for job in jobs)} failed: {e}')
+            finished = []
+            error = str(e)
+
+        if on_event:
+            finished_ids = {job['PublisherID'] for job in finished}
+            for job in finished:
+                on_event(job, self.name, 'done')
+            for job in jobs:
+                if not job['PublisherID'] in finished_ids:
+                    on_event(job, self.name, 'failed', error)
+
+        end = perf_counter()
+        with self.lock:
+            self.busy_time += end - start
+            self.finished = end
+            self.done += len(finished)
+            self.failed += len(jobs) - len(finished)
+            if self.measure:
+                self.bytes += sum(self.measure(job) for job in finished)
+
+        return finished
+
+    def summary(self):
+        wall_time = (self.finished - self.started) if self.started is not None else 0.0
+        items_per_min = (self.done / wall_time * 60) if wall_time else 0.0
+        bytes_per_sec = (self.bytes / wall_time) if wall_time else 0.0
+        return (
+            f'{self.name}: {self.done} done, {self.failed} failed, {self.workers} worker(s), '
+            f'busy {self.busy_time:0.1f}s over {wall_time:0.1f}s, '
+            f'{items_per_min:0.2f} items/min, {format_bytes(bytes_per_sec)}/s'
+        )
+
+
+PIPELINE_STOP = object()
+
+
+def run_pipeline(jobs, stages, queue_size=2, on_event=None):
+    queues = [queue.Queue(maxsize=max(1, queue_size, stage.batch_size)) for stage in stages]
+    results = []
+    results_lock = threading.Lock()
+
+    def stage_worker(index):
+        stage = stages[index]
+        while True:
+            job = queues[index].get()
+            if job is PIPELINE_STOP:
+                queues[index].put(PIPELINE_STOP)
+                return
+
+            jobs = [job]
+            while len(jobs) < stage.batch_size:
+                try:
+                    job = queues[index].get_nowait()
+                except queue.Empty:
+                    break
+                if job is PIPELINE_STOP:
+                    queues[index].put(PIPELINE_STOP)
+                    break
+                jobs.append(job)
+
+            finished = stage.run(jobs, on_event)
+            finished_ids = {job['PublisherID'] for job in finished}
+            for job in jobs:
+                if not job['PublisherID'] in finished_ids:
+                    DISK_BUDGET.release(job['PublisherID'], failed=True)
+
+            for job in finished:
+                if index + 1 < len(stages):
+                    queues[index + 1].put(job)
+                else:
+                    DISK_BUDGET.release(job['PublisherID'])
+                    with results_lock:
+                        results.append(job)
+
+    stage_threads = []
+    for index, stage in enumerate(stages):
+        threads = [threading.Thread(target=stage_worker, args=(index,), daemon=True) for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        stage_threads.append(threads)
+
+    pipeline_start = perf_counter()
+    for job in jobs:
+        # a job only starts when its download, staging and archive fit in the disk budget
+        steam_data = job.get('steam_data') or {}
+        try:
+            if get_unchanged_cache(job['PublisherID'], steam_data.get('time_updated')):
+                DISK_BUDGET.hold(job['PublisherID'])
+            else:
+                DISK_BUDGET.admit(job['PublisherID'], steam_data.get('file_size'))
+        except Exception as e:
+            print(f'[Pipeline] {job["PublisherID"]} skipped: {e}')
+            if on_event:
+                on_event(job, 'disk', 'failed', str(e))
+            continue
+
+        queues[0].put(job)
+    queues[0].put(PIPELINE_STOP)
+
+    for index, threads in enumerate(stage_threads):
+        for thread in threads:
+            thread.join()
+        if index + 1 < len(stages):
+            queues[index + 1].put(PIPELINE_STOP)
+
+    print(f'\n[Pipeline] {len(results)} item(s) finished in {perf_counter() - pipeline_start:0.1f}s')
+    for stage in stages:
+        print(f'[Pipeline] {stage.summary()}')
+    METRICS.write_prometheus()
+
+    return results
+
+
+def fetch_steam_data(workshop_id, steam_soup=None, metadata_provider=METADATA_PROVIDER):
+    steam_data = prefetch_steam_data([workshop_id], metadata_provider).get(workshop_id)
+    if steam_data:
+        return complete_steam_data(workshop_id, steam_data, steam_soup)
+
+    if steam_soup is None:
+        steam_soup = fetch_steam_page(workshop_id)
+        if not steam_soup:
+            raise Exception(f'Invalid SteamID {workshop_id}')
+
+    return scrape_steam_data(steam_soup, fetch_changelog_page(workshop_id))
+
+
+def download_stage(jobs):
+    scraped_jobs = []
+    cached_jobs = []
+    for job in jobs:
+        try:
+            steam_data = job.pop('steam_data', None)
+            if steam_data:
+                scrape_data = complete_steam_data(job['PublisherID'], steam_data)
+            else:
+                scrape_data = fetch_steam_data(job['PublisherID'], metadata_provider='html')
+        except Exception as e:
+            print(f'[download] {job["PublisherID"]} failed: {e}')
+            continue
+
+        cached_json = reuse_unchanged_cache(job['PublisherID'], scrape_data)
+        if cached_json:
+            # items only known to be unchanged from their pages give back the room reserved for them
+            DISK_BUDGET.hold(job['PublisherID'])
+            cached_jobs.append({**cached_json, 'cached': True})
+        else:
+            job.update(scrape_data)
+            scraped_jobs.append(job)
+
+    if not scraped_jobs:
+        return cached_jobs
+
+    with STEAMCMD_POOL.acquire() as worker:
+        downloaded = download_workshop_items([job['PublisherID'] for job in scraped_jobs], worker)
+
+    # items that kept failing are dropped like the ones without steam data
+    scraped_jobs = [job for job in scraped_jobs if job['PublisherID'] in downloaded]
+    for job in scraped_jobs:
+        job['content_bytes'] = downloaded[job['PublisherID']]
+        JOB_STORE.update(job['PublisherID'], 'downloaded')
+
+    return cached_jobs + scraped_jobs
+
+
+def make_package_stage(archiver):
+    def package_stage(job):
+        if job.get('cached'):
+            return job
+
+        make_patch = job.pop('make_patch', False)
+        files_data = package_workshop_item(job['PublisherID'], archiver, make_patch)
+        workshop_json = {**files_data, **job}
+        cache_content(workshop_json)
+        # from here on the archives are counted as cache usage
+        DISK_BUDGET.release(job['PublisherID'])
+
+        return workshop_json
+
+    return package_stage
+
+
+def make_upload_stage(tg_client, tg_channels, volume_workers=UPLOAD_VOLUME_WORKERS, part_workers=UPLOAD_PART_WORKERS):
+    def upload_stage(job):
+        # without channels every item goes back to the channels it was posted in
+        job_channels = tg_channels or JOB_STORE.post_channels(job['PublisherID'])
+        job['telegram_link'] = make_telegram_post(tg_client, job_channels, job, volume_workers, part_workers)
+
+        return job
+
+    return upload_stage
+
+
+def make_stream_stage(tg_client, tg_channels, archiver, volume_workers=UPLOAD_VOLUME_WORKERS, part_workers=UPLOAD_PART_WORKERS):
+    def stream_stage(job):
+        job_channels = tg_channels or JOB_STORE.post_channels(job['PublisherID'])
+        if job.get('cached'):
+            job['telegram_link'] = make_telegram_post(tg_client, job_channels, job, volume_workers, part_workers)
+            return job
+
+        make_patch = job.pop('make_patch', False)
+        (files_data, norm_workshopname) = prepare_workshop_item(job['PublisherID'], make_patch)
+        workshop_json = {**files_data, **job}
+        # set until the archive is complete, an interrupted stream can't be resumed without its volumes
+        JOB_STORE.update(workshop_json['PublisherID'], data={'streaming': True})
+
+        archive_process = start_archive(workshop_json, norm_workshopname, archiver)
+        archive_volumes = iter_finished_volumes(archive_process, workshop_json['PublisherID'], norm_workshopname, archiver)
+        workshop_json['telegram_link'] = make_telegram_post(
+            tg_client, job_channels, workshop_json, volume_workers, part_workers,
+            rar_paths=archive_volumes,
+            find_volumes=partial(find_archive_volumes, workshop_json['PublisherID'], norm_workshopname, archiver)
+        )
 
+        collect_archive_files(workshop_json, norm_workshopname, archiver)
+        workshop_json['streaming'] = False
+        cache_content(workshop_json, 'done')
 
-    os.chdir(INITIAL_CWD)
+        return workshop_json
 
-    tg_client.stop()
+    return stream_stage
 
 
-def steam_action():
+def steam_action(archiver=None):
     (workshop_id, steam_soup) = ask_for_steam_input()
 
-    changelog_content = requests.get(f'{STEAM_URL}changelog/{workshop_id}').content
-    changelog_soup = BeautifulSoup(changelog_content, 'html.parser')
+    scrape_data = fetch_steam_data(workshop_id, steam_soup)
+    workshop_json = reuse_unchanged_cache(workshop_id, scrape_data)
+    if workshop_json:
+        return workshop_json
 
-    scrape_data = scrape_steam_data(steam_soup, changelog_soup)
-    files_data = download_and_package(workshop_id)
+    with DISK_BUDGET.reserve(workshop_id, scrape_data.get('file_size')):
+        files_data = download_and_package(workshop_id, archiver)
     workshop_json = {**files_data, **scrape_data}
     cache_content(workshop_json)
 
     return workshop_json
 
 
-def telegram_action():
+def telegram_action(args):
     tg_client = ensure_telegram_connection()
-    tg_channel = ask_for_telegram_input(tg_client)
+    tg_channels = ask_for_telegram_input(tg_client)
 
     (workshop_id, steam_soup) = ask_for_steam_input()
 
-    changelog_content = requests.get(f'{STEAM_URL}changelog/{workshop_id}').content
-    changelog_soup = BeautifulSoup(changelog_content, 'html.parser')
-
-    scrape_data = scrape_steam_data(steam_soup, changelog_soup)
+    scrape_data = fetch_steam_data(workshop_id, steam_soup)
 
     workshop_json = {
         **scrape_data, 
         'PublisherID': workshop_id,
     }
 
-    make_telegram_post(tg_client, tg_channel, workshop_json)
+    make_telegram_post(tg_client, tg_channels, workshop_json, args.volume_workers, args.part_workers)
+    TELEGRAM_LOOP.call(tg_client.stop)
 
 
-def telegram_and_steam_action():
+def telegram_and_steam_action(args, archiver=None):
     tg_client = ensure_telegram_connection()
-    tg_channel = ask_for_telegram_input(tg_client)
+    tg_channels = ask_for_telegram_input(tg_client)
 
-    workshop_json = steam_action()
+    workshop_json = steam_action(archiver)
 
-    map_cachedir = CACHE_DIR.joinpath(workshop_json['PublisherID'])
-    make_telegram_post(tg_client, tg_channel, workshop_json)
-    shutil.rmtree(map_cachedir)
+    make_telegram_post(tg_client, tg_channels, workshop_json, args.volume_workers, args.part_workers)
+    TELEGRAM_LOOP.call(tg_client.stop)
 
-def check_and_upload_cache_action():
-    content_paths = []
-    for content_path in CACHE_DIR.iterdir():
-        if content_path.is_dir() and len(content_path.name) == 10 and content_path.name.isdigit():
-            content_paths.append(content_path)
-
-    if len(content_paths) > 0:
-        contents_json_list = []
-        for content_path in content_paths:
-            with open(content_path.joinpath(f'{content_path.name}.json')) as fhandler:
-                contents_json_list.append(json.loads(fhandler.read()))
+def check_and_upload_cache_action(args):
+    pending_jobs = JOB_STORE.pending()
+
+    if len(pending_jobs) > 0:
+        contents_json_list = [pending_job['data'] for pending_job in pending_jobs]
         
         while True:
             cache_upload_input = input('Found items in cache. Upload them (y/n)? ').lower()
@@ -641,50 +3180,458 @@ def check_and_upload_cache_action():
             
             
             tg_client = ensure_telegram_connection()
-            tg_channel = ask_for_telegram_input(tg_client)
+            tg_channels = ask_for_telegram_input(tg_client)
             for upload in upload_list:
-                make_telegram_post(tg_client, tg_channel, contents_json_list[upload])
-                shutil.rmtree(CACHE_DIR.joinpath(contents_json_list[upload]['PublisherID']))
+                make_telegram_post(tg_client, tg_channels, contents_json_list[upload], args.volume_workers, args.part_workers)
+            TELEGRAM_LOOP.call(tg_client.stop)
+
+
+def collection_action(args, archiver):
+    tg_client = ensure_telegram_connection()
+    args.channel = ask_for_telegram_input(tg_client)
+
+    while True:
+        collection_id = parse_workshop_input(input('Steam collection ID | URL: '))
+        if collection_id:
+            break
+        print('Invalid input. Try again')
+
+    args.batch = [collection_id]
+    batch_action(args, archiver, tg_client)
+
+
+def read_batch_inputs(entries):
+    workshop_ids = []
+    for entry in entries:
+        if Path(entry).is_file():
+            with open(entry) as fhandle:
+                lines = [line.strip() for line in fhandle.read().splitlines()]
+            lines = [line for line in lines if line and not line.startswith('#')]
+        else:
+            lines = [entry]
+
+        for line in lines:
+            workshop_id = parse_workshop_input(line)
+            if not workshop_id:
+                print(f'Invalid input \'{line}\'. Skipping')
+            elif workshop_id not in workshop_ids:
+                workshop_ids.append(workshop_id)
+
+    return workshop_ids
+
+
+def make_pipeline_stages(args, archiver, tg_client, tg_channels):
+    stages = [
+        PipelineStage('download', download_stage, max(args.download_workers, args.steamcmd_workers), lambda job: job.get('content_bytes', 0), args.steamcmd_batch),
+    ]
+
+    if args.stream:
+        stages.append(
+            PipelineStage('package+upload', make_stream_stage(tg_client, tg_channels, archiver, args.volume_workers, args.part_workers), args.upload_workers, lambda job: job.get('archive_bytes', 0))
+        )
+    else:
+        stages.append(PipelineStage('package', make_package_stage(archiver), args.package_workers, lambda job: job.get('archive_bytes', 0)))
+        if tg_client:
+            stages.append(
+                PipelineStage('upload', make_upload_stage(tg_client, tg_channels, args.volume_workers, args.part_workers), args.upload_workers, lambda job: job.get('archive_bytes', 0))
+            )
+
+    return stages
 
 
-if not RAR_PATH.is_dir:
-    raise Exception('WinRAR not found at C:')
+def batch_action(args, archiver, tg_client=None):
+    (workshop_ids, collections) = expand_collections(read_batch_inputs(args.batch))
+    if not workshop_ids:
+        raise Exception('No valid workshop items to process')
 
-if not Path('steamcmd.exe').exists():
-    raise Exception('steamcmd.exe not found at same folder as the script')
+    if args.stream and args.channel is None:
+        raise Exception('--stream needs a --channel to upload to')
 
-if not CACHE_DIR.exists():
-    CACHE_DIR.mkdir()
-else:
-    check_and_upload_cache_action()
+    if tg_client is None and args.channel is not None:
+        tg_client = ensure_telegram_connection()
+        for channel_id in args.channel:
+            chat = TELEGRAM_LOOP.run(get_telegram_channel(tg_client, channel_id))
+            print(f'Will upload to \'{chat.title}\' and \'{chat.linked_chat.title}\'')
 
+    stages = make_pipeline_stages(args, archiver, tg_client, args.channel)
 
-MENU = [
-    ('Download & Package & Cache', steam_action),
-    ('Create telegram post', telegram_action),
-    ('Download & Package & Upload to telegram', telegram_and_steam_action),
-]
+    print(f'Processing {len(workshop_ids)} item(s)')
+    for workshop_id in workshop_ids:
+        JOB_STORE.update(workshop_id, 'queued')
+    steam_data_batch = prefetch_steam_data(workshop_ids, args.metadata)
+    jobs = [{'PublisherID': workshop_id, 'steam_data': steam_data_batch.get(workshop_id)} for workshop_id in workshop_ids]
+    results = run_pipeline(jobs, stages, args.queue_size)
 
-while True:
-    for i, menu_item in enumerate(MENU):
-        print(str(i + 1) + ' - ' + menu_item[0])
+    if tg_client:
+        if collections:
+            post_collection_summaries(tg_client, args.channel, collections, results)
+        TELEGRAM_LOOP.call(tg_client.stop)
 
+    return results
+
+
+def poll_updated_items(workshop_ids):
+    # one GetPublishedFileDetails request per 100 items, whatever the number of watched items
+    file_details = fetch_published_file_details(workshop_ids)
+
+    updated_ids = []
+    for workshop_id in workshop_ids:
+        details = file_details.get(workshop_id)
+        job = JOB_STORE.get(workshop_id)
+        if not details or not job:
+            continue
+
+        if job['time_updated'] is None:
+            # items posted without packaging have no version yet, the current one becomes the reference
+            JOB_STORE.update(workshop_id, time_updated=details['time_updated'])
+        elif not details['time_updated'] == job['time_updated'] or not job['state'] == 'done':
+            # interrupted updates are picked up again too
+            updated_ids.append(workshop_id)
+
+    return updated_ids
+
+
+def watch_action(args, archiver):
+    tg_client = ensure_telegram_connection()
+    interval = args.watch_interval
     try:
-        menu_input = input('Choose an option (default 3): ')
-        if menu_input == '':
-            menu_input = len(MENU) - 1
-            break
+        while True:
+            posted_ids = JOB_STORE.posted()
+            if args.watch:
+                watched_ids = [workshop_id for workshop_id in read_batch_inputs(args.watch) if workshop_id in posted_ids]
+            else:
+                watched_ids = posted_ids
+
+            try:
+                updated_ids = poll_updated_items(watched_ids)
+            except Exception as e:
+                print(f'[Watch] Steam API request failed ({e})')
+                updated_ids = None
+
+            if updated_ids:
+                print(f'[Watch] Updating {len(updated_ids)} item(s): {", ".join(updated_ids)}')
+                for workshop_id in updated_ids:
+                    if JOB_STORE.get(workshop_id)['state'] == 'done':
+                        JOB_STORE.reopen_posts(workshop_id)
+
+                steam_data_batch = prefetch_steam_data(updated_ids, args.metadata)
+                jobs = [
+                    {'PublisherID': workshop_id, 'steam_data': steam_data_batch.get(workshop_id), 'make_patch': not args.full_archives}
+                    for workshop_id in updated_ids
+                ]
+                # no channels, every item is updated in the posts it already has
+                run_pipeline(jobs, make_pipeline_stages(args, archiver, tg_client, None), args.queue_size)
+                interval = args.watch_interval
+            else:
+                # quiet items are checked less and less often
+                interval = min(interval * WATCH_BACKOFF, args.watch_max_interval)
+
+            print(f'[Watch] {len(watched_ids)} item(s) watched. Next check in {format_duration(interval)}')
+            sleep(interval)
+    finally:
+        TELEGRAM_LOOP.call(tg_client.stop)
+
+
+class JobService:
+    def __init__(self, args, archiver):
+        self.args = args
+        self.tg_client = None
+        self.jobs = {}
+        self.subscribers = {}
+        self.submissions = queue.Queue()
+        self.loop = None
+        # one pipeline, with the worker counts of the command line, runs the jobs of every requester
+        self.stages = [
+            PipelineStage('download', download_stage, max(args.download_workers, args.steamcmd_workers), lambda job: job.get('content_bytes', 0), args.steamcmd_batch),
+            PipelineStage('package', make_package_stage(archiver), args.package_workers, lambda job: job.get('archive_bytes', 0)),
+            PipelineStage('upload', self.upload_stage, args.upload_workers, lambda job: job.get('archive_bytes', 0)),
+        ]
+
+    def upload_stage(self, job):
+        service_job = self.jobs[job['PublisherID']]
+        if service_job['mode'] == 'upload':
+            job['telegram_link'] = make_telegram_post(self.tg_client, service_job['channels'], job, self.args.volume_workers, self.args.part_workers)
+
+        return job
+
+    def iter_submissions(self):
+        while True:
+            workshop_ids = [self.submissions.get()]
+            while not self.submissions.empty():
+                workshop_ids.append(self.submissions.get())
+
+            stopping = None in workshop_ids
+            workshop_ids = [workshop_id for workshop_id in workshop_ids if workshop_id is not None]
+            # jobs submitted together share one Steam API request
+            steam_data_batch = prefetch_steam_data(workshop_ids, self.args.metadata) if workshop_ids else {}
+            for workshop_id in workshop_ids:
+                yield {'PublisherID': workshop_id, 'steam_data': steam_data_batch.get(workshop_id)}
+
+            if stopping:
+                return
+
+    def on_event(self, job, stage_name, status, error=None):
+        # called from the pipeline threads, the job list is only changed in the event loop
+        event = {'time': round(time(), 3), 'stage': stage_name, 'status': status}
+        if error:
+            event['error'] = error
+        if status == 'done' and stage_name == self.stages[-1].name:
+            event['result'] = {field: job.get(field) for field in SERVICE_RESULT_FIELDS if field in job}
+
+        self.loop.call_soon_threadsafe(self.publish, job['PublisherID'], event)
+
+    def publish(self, workshop_id, event):
+        service_job = self.jobs[workshop_id]
+        service_job['events'].append(event)
+        if event['status'] == 'failed':
+            service_job['state'] = 'failed'
+        elif 'result' in event:
+            service_job['state'] = 'done'
+            service_job['result'] = event['result']
+        else:
+            service_job['state'] = 'running'
+
+        for subscriber in self.subscribers.get(workshop_id, []):
+            subscriber.put_nowait(event)
+
+    def job_view(self, service_job, with_events=False):
+        return {field: value for field, value in service_job.items() if with_events or not field == 'events'}
+
+    async def submit(self, body):
+        request = json.loads(body or b'{}')
+        workshop_id = parse_workshop_input(str(request.get('workshop_id', '')))
+        mode = request.get('mode', 'upload')
+        channels = request.get('channels') or self.args.channel or []
+        if not workshop_id:
+            return (400, {'error': 'workshop_id must be a workshop id or url'})
+        if not mode in SERVICE_MODES:
+            return (400, {'error': f'mode must be one of {", ".join(SERVICE_MODES)}'})
+        if mode == 'upload' and not channels:
+            return (400, {'error': 'upload jobs need channels'})
+        if workshop_id in self.jobs and self.jobs[workshop_id]['state'] in ('queued', 'running'):
+            return (409, {'error': f'{workshop_id} is already queued', 'job': self.job_view(self.jobs[workshop_id])})
+
+        try:
+            channels = [int(channel) for channel in channels]
+            for channel in channels:
+                await get_telegram_channel(self.tg_client, channel)
+        except Exception as e:
+            return (400, {'error': f'Invalid channel: {e}'})
+
+        self.jobs[workshop_id] = {'workshop_id': workshop_id, 'mode': mode, 'channels': channels, 'state': 'queued', 'submitted': round(time(), 3), 'events': []}
+        JOB_STORE.update(workshop_id, 'queued')
+        self.submissions.put(workshop_id)
+        print(f'[API] Queued {workshop_id} ({mode})')
+
+        return (202, self.job_view(self.jobs[workshop_id]))
+
+    def respond(self, writer, status, payload=None, content_type='application/json'):
+        headers = f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\nConnection: close\r\n'
+        if payload is None:
+            writer.write((headers + '\r\n').encode())
+        else:
+            body = json.dumps(payload).encode()
+            writer.write((headers + f'Content-Length: {len(body)}\r\n\r\n').encode() + body)
+
+    async def stream_events(self, writer, workshop_id):
+        # newline delimited json, the past events first and then every new one until the job ends
+        events = asyncio.Queue()
+        for event in self.jobs[workshop_id]['events']:
+            events.put_nowait(event)
+        self.subscribers.setdefault(workshop_id, []).append(events)
+
+        self.respond(writer, 200, content_type='application/x-ndjson')
+        try:
+            while True:
+                event = await events.get()
+                writer.write((json.dumps(event) + '\n').encode())
+                await writer.drain()
+                if event['status'] == 'failed' or 'result' in event:
+                    break
+        finally:
+            self.subscribers[workshop_id].remove(events)
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                header_line = (await reader.readline()).decode('latin-1').strip()
+                if not header_line:
+                    break
+                (header_name, _, header_value) = header_line.partition(':')
+                headers[header_name.strip().lower()] = header_value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            (method, path) = request_line[:2]
+            path_parts = [path_part for path_part in path.split('?')[0].split('/') if path_part]
+            if not path_parts or not path_parts[0] == 'jobs' or len(path_parts) > 3:
+                self.respond(writer, 404, {'error': 'Not found'})
+            elif len(path_parts) == 1 and method == 'GET':
+                self.respond(writer, 200, [self.job_view(service_job) for service_job in self.jobs.values()])
+            elif len(path_parts) == 1 and method == 'POST':
+                self.respond(writer, *(await self.submit(body)))
+            elif not path_parts[1] in self.jobs:
+                self.respond(writer, 404, {'error': f'No job for {path_parts[1]}'})
+            elif len(path_parts) == 2 and method == 'GET':
+                self.respond(writer, 200, self.job_view(self.jobs[path_parts[1]], with_events=True))
+            elif path_parts[2:] == ['events'] and method == 'GET':
+                await self.stream_events(writer, path_parts[1])
+            else:
+                self.respond(writer, 405, {'error': 'Method not allowed'})
+
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print(f'[API] Error: {e}')
+            self.respond(writer, 400, {'error': str(e)})
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        # the api runs on the telegram loop, the client is started here and awaited directly by the handlers
+        self.loop = asyncio.get_running_loop()
+        self.tg_client = await self.loop.run_in_executor(None, ensure_telegram_connection)
+        threading.Thread(target=run_pipeline, args=(self.iter_submissions(), self.stages, self.args.queue_size, self.on_event), daemon=True).start()
+
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Job API listening on http://{host}:{port}/jobs')
+        async with server:
+            await server.serve_forever()
+
+
+def serve_action(args, archiver):
+    service = JobService(args, archiver)
+    try:
+        TELEGRAM_LOOP.run(service.serve(args.serve_host, args.serve))
+    finally:
+        service.submissions.put(None)
+        if service.tg_client:
+            TELEGRAM_LOOP.call(service.tg_client.stop)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Automation of BO3 mod/map download and sending to Telegram.')
+    parser.add_argument('--batch', nargs='+', metavar='ID|URL|FILE', help='workshop ids, urls or files with one per line. Runs without the interactive menu')
+    parser.add_argument('--watch', nargs='*', metavar='ID|URL|FILE', help='keep running and update the posts of these items (default every posted item) when they are updated on steam')
+    parser.add_argument('--watch-interval', type=int, default=WATCH_MIN_INTERVAL, help='seconds between update checks, doubled after every check without updates')
+    parser.add_argument('--watch-max-interval', type=int, default=WATCH_MAX_INTERVAL, help='max seconds between update checks')
+    parser.add_argument('--full-archives', action='store_true', help='send the full archive of items updated in --watch instead of a patch with the changed files')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='run a local HTTP job API on this port instead of the interactive menu')
+    parser.add_argument('--serve-host', default=SERVE_HOST, help='address the job API listens on')
+    parser.add_argument('--channel', type=int, nargs='+', help='telegram channel ids to upload to, archives are uploaded once for all of them. Without it batch items are only cached')
+    parser.add_argument('--download-workers', type=int, default=1, help='concurrent download jobs (steamcmd itself runs one at a time without --steamcmd-workers)')
+    parser.add_argument('--steamcmd-workers', type=int, default=0, help=f'steamcmd installs in {STEAMCMD_WORKERS_DIR.name} that download at the same time, each with its own content folder')
+    parser.add_argument('--stall-timeout', type=int, default=STEAMCMD_STALL_TIMEOUT, help='seconds without downloaded bytes before steamcmd is restarted to resume the item (0 disables it)')
+    parser.add_argument('--steamcmd-batch', type=int, default=5, help='max items downloaded in a single steamcmd session')
+    parser.add_argument('--package-workers', type=int, default=1, help='concurrent packaging jobs')
+    parser.add_argument('--upload-workers', type=int, default=1, help='concurrent telegram posts')
+    parser.add_argument('--volume-workers', type=int, default=UPLOAD_VOLUME_WORKERS, help='rar volumes of an album uploaded at the same time')
+    parser.add_argument('--upload-sessions', nargs='+', metavar='SESSION', help=f'extra session files logged in the same account as {SESSION_NAME}.session, volumes are uploaded through the least loaded session')
+    parser.add_argument('--part-workers', type=int, default=UPLOAD_PART_WORKERS, help='file parts of a rar volume uploaded at the same time')
+    parser.add_argument('--metadata', choices=('api', 'html'), default=METADATA_PROVIDER, help='read item details from the Steam web API in batches or from the item pages')
+    parser.add_argument('--html-extractor', choices=HTML_EXTRACTORS, default=HTML_EXTRACTOR, help='full parses whole steam pages, strainer and lxml only keep the nodes that are read')
+    parser.add_argument('--manifest-hashes', action='store_true', help='also store a sha1 of every item file in the content manifest')
+    parser.add_argument('--benchmark-parser', nargs='+', metavar='HTML_FILE', help='compare parse time, peak memory and extracted nodes of every html extractor on saved steam pages')
+    parser.add_argument('--archiver', choices=list(ARCHIVERS), help='archive format (default rar, or zip when rar is not installed)')
+    parser.add_argument('--archive-threads', type=int, default=ARCHIVE_THREADS, help='compression threads')
+    parser.add_argument('--archive-level', type=int, help='compression level of the chosen archiver: 0-5 for rar, 0-9 for 7z and zip, 1-22 for tar.zst')
+    parser.add_argument('--type-level', type=parse_type_level, nargs='+', metavar='EXT=LEVEL', help='compression level of a file type, 0 stores it (.ff, .xpak and .ipak are stored by default). rar, 7z and tar.zst use the highest level of the compressed types for the whole archive')
+    parser.add_argument('--stream', action='store_true', help='upload each archive volume as soon as the archiver finishes it instead of caching the archive first (not with 7z)')
+    parser.add_argument('--disk-budget', type=float, help='GB that downloads, staging and cached archives may use. Jobs wait for room and posted items are evicted from the cache, least recently used first')
+    parser.add_argument('--queue-size', type=int, default=2, help='max items waiting between two stages')
+    return parser.parse_args()
+
+
+def main():
+    global HTML_EXTRACTOR, MANIFEST_HASHES, STEAMCMD_STALL_TIMEOUT, STEAMCMD_POOL
+
+    args = parse_args()
+    HTML_EXTRACTOR = args.html_extractor
+    MANIFEST_HASHES = args.manifest_hashes
+    STEAMCMD_STALL_TIMEOUT = args.stall_timeout
+
+    if args.benchmark_parser:
+        benchmark_html_extractors(args.benchmark_parser)
+        return
+
+    archiver = get_archiver(args.archiver, args.archive_threads, args.archive_level, {**ARCHIVE_TYPE_LEVELS, **dict(args.type_level or [])})
+    if args.stream and not archiver.streamable:
+        raise Exception(f'--stream can not be used with the {archiver.name} archiver, its first volume is only complete once the whole archive is written')
+
+    if not Path('steamcmd.exe').exists():
+        raise Exception('steamcmd.exe not found at same folder as the script')
+
+    if args.steamcmd_workers:
+        STEAMCMD_POOL = SteamcmdPool(args.steamcmd_workers)
+
+    if args.disk_budget:
+        DISK_BUDGET.budget = int(args.disk_budget * 1024 * 1024 * 1024)
+
+    if args.upload_sessions:
+        UPLOAD_POOL.session_names = args.upload_sessions
+        UPLOAD_POOL.start()
+
+    if args.serve:
+        CACHE_DIR.mkdir(exist_ok=True)
+        evict_http_cache()
+        serve_action(args, archiver)
+        return
+
+    if args.watch is not None:
+        CACHE_DIR.mkdir(exist_ok=True)
+        evict_http_cache()
+        watch_action(args, archiver)
+        return
+
+    if args.batch:
+        CACHE_DIR.mkdir(exist_ok=True)
+        evict_http_cache()
+        batch_action(args, archiver)
+        return
+
+    if not CACHE_DIR.exists():
+        CACHE_DIR.mkdir()
+    else:
+        evict_http_cache()
+        check_and_upload_cache_action(args)
+
+
+    MENU = [
+        ('Download & Package & Cache', partial(steam_action, archiver)),
+        ('Create telegram post', partial(telegram_action, args)),
+        ('Download & Package & Upload to telegram', partial(telegram_and_steam_action, args, archiver)),
+        ('Download & Package & Upload a Steam collection to telegram', partial(collection_action, args, archiver)),
+    ]
+
+    while True:
+        for i, menu_item in enumerate(MENU):
+            print(str(i + 1) + ' - ' + menu_item[0])
+
+        try:
+            menu_input = input('Choose an option (default 3): ')
+            if menu_input == '':
+                menu_input = 2
+                break
         
-        menu_input = int(menu_input) - 1
-    except ValueError:
-        print('Invalid input. Try again')
-        continue
+            menu_input = int(menu_input) - 1
+        except ValueError:
+            print('Invalid input. Try again')
+            continue
+
+        if not (menu_input > 0 or menu_input <= len(MENU)):
+            print('Invalid option. Try again')
+            continue
 
-    if not (menu_input > 0 or menu_input <= len(MENU)):
-        print('Invalid option. Try again')
-        continue
+        break
 
-    break
+    MENU[menu_input][1]()
+    METRICS.write_prometheus()
 
-MENU[menu_input][1]()
 
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        UPLOAD_POOL.stop()